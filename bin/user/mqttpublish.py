@@ -16,6 +16,39 @@ Configuration:
         # Only used by the service.
         binding = loop
 
+        # The maximum number of queued archive records published as a batch, for example when catching up.
+        # Default is 100.
+        archive_batch_size = 100
+
+        # The maximum number of seconds to publish queued data and wait for acknowledgements when WeeWX shuts down.
+        # Default is 20.
+        shutdown_timeout = 20
+
+        # A file that data not published at shutdown is saved to, it is published when WeeWX restarts.
+        # Default is None, unpublished data is discarded.
+        spool = None
+
+        # The relative share of publishing each priority lane gets when more than one has queued data.
+        # In the order: archive, guaranteed, loop.
+        # Default is 4, 2, 1.
+        priority_weights = 4, 2, 1
+
+        # Where the publishing runs.
+        # thread: a thread in the WeeWX process.
+        # process: a separate process, so that formatting and publishing do not compete with WeeWX for the GIL.
+        #          WeeWX only queues the data. The process is forked, so it has the units and xtypes that
+        #          other extensions added. Not supported where processes cannot be forked, for example Windows.
+        # Default is thread.
+        mode = thread
+
+        # The number of times the publishing thread or process is restarted if it stops.
+        # Default is 2.
+        max_restarts = 2
+
+        # The data binding of the database used to calculate aggregates.
+        # Default is wx_binding.
+        data_binding = wx_binding
+
         # Controls the MQTT logging.
         # Default is false.
         log = false
@@ -24,8 +57,25 @@ Configuration:
         # Service default is MQTTSubscribeService-xxxx.
         # Driver default is MQTTSubscribeDriver-xxxx.
         #    Where xxxx is a random number between 1000 and 9999.
+        # When persistent_session is True, the clientid is generated as MQTTPublish-<uuid>, so that it is unique,
+        # and saved in clientid_file and used from then on.
         clientid =
 
+        # Keep the MQTT session on the broker when disconnected.
+        # This helps reconnects while WeeWX is running: the client keeps its unacknowledged QOS 1/2 messages
+        # in memory and completes them with the broker's session after reconnecting.
+        # The client's state is lost when WeeWX restarts, so data not published by then relies on the spool option.
+        # Default is False.
+        persistent_session = False
+
+        # The number of seconds the broker keeps the session after a disconnect, when the protocol is MQTTv5.
+        # Default is 3600.
+        session_expiry_interval = 3600
+
+        # The file the generated clientid is saved in, relative to WEEWX_ROOT.
+        # Default is mqttpublish.clientid.
+        clientid_file = mqttpublish.clientid
+
         # The MQTT server.
         # Default is localhost.
         host = localhost
@@ -35,7 +85,7 @@ Configuration:
         port = 1883
 
         # The protocol to use
-        # Valid values: MQTTv31, MQTTv311
+        # Valid values: MQTTv31, MQTTv311, MQTTv5
         # Default is MQTTv311,
         protocol = MQTTv311
 
@@ -71,6 +121,196 @@ Configuration:
             # The default is True.
             retain = True
 
+        # Stop WeeWX when the publishing thread or process has stopped and cannot be restarted.
+        # Valid values: threadEnded
+        # Default is None.
+        kill_weewx = None
+
+        [[[watchdog]]]
+            # The number of seconds the publishing thread can go without a heartbeat before it is stalled.
+            # The thread beats at least every keepalive/4 seconds, unless it is stuck, for example reconnecting.
+            # Default is None, not checked.
+            stall_timeout = None
+
+            # What to do when the thread has stalled.
+            # Valid values: restart, shed, kill_weewx
+            # restart: a stalled thread cannot be stopped, so it is told to exit once it is no longer stuck,
+            #          and a new thread is started with the clientid with '-restart<n>' appended.
+            #          So the two threads do not take over each other's MQTT session.
+            #          The new thread does not resume a persistent session.
+            # shed: loop lane topics are not queued until the thread has a heartbeat again.
+            # Default is restart.
+            stall_action = restart
+
+            # The maximum number of seconds between a loop packet's time and its publication.
+            # Default is None, not checked.
+            max_lag = None
+
+            # What to do when the lag is more than max_lag.
+            # Valid values: restart, shed, kill_weewx
+            # shed: loop lane topics are not queued until the thread catches up.
+            # Archive records and guaranteed lane topics are always queued.
+            # Default is shed.
+            lag_action = shed
+
+            # A topic that the heartbeat age, lag and queue depth are published to as JSON, for monitoring.
+            # Default is None.
+            monitor_topic = None
+
+            # How often, in seconds, the monitor topic is published.
+            # Default is 60.
+            monitor_interval = 60
+
+        [[[profile]]]
+            # Profile the publishing thread for a bounded window, then write the results and log the top functions.
+            # There is no overhead when not enabled.
+            # Default is False.
+            enable = False
+
+            # cprofile: profile every function call, written as pstats to <output>.pstats.
+            # sample: sample the thread's stack every 'interval' seconds, written as collapsed stacks to <output>.collapsed.
+            # Default is cprofile.
+            mode = cprofile
+
+            # The number of queue items, loop packets or archive records, to profile.
+            # Default is 100.
+            packets = 100
+
+            # The maximum number of seconds to profile.
+            # Default is None, no limit.
+            seconds = None
+
+            # The path, without extension, of the output file.
+            # Default is mqttpublish-profile in the temporary directory.
+            output =
+
+            # The sampling interval in seconds, when the mode is sample.
+            # Default is 0.005.
+            interval = 0.005
+
+            # The number of functions to log.
+            # Default is 20.
+            top = 20
+
+        [[[load_shedding]]]
+            # Degrade loop topics when the broker is slow to acknowledge or the queue backs up.
+            # Archive records and guaranteed lane topics are never degraded.
+            # Level 1: only every 'rate_divisor'th loop packet is published.
+            # Level 2: also, loop topics only publish the fields that changed.
+            # Level 3: also, individual loop topics are not published.
+            # Default is False.
+            enable = False
+
+            # The broker acknowledgement latency, in seconds, at which each level starts.
+            # The latency is measured from QOS 1/2 messages.
+            # Default is 0.5, 2, 5.
+            latency_thresholds = 0.5, 2, 5
+
+            # The queue depth at which each level starts.
+            # Default is 50, 200, 500.
+            queue_thresholds = 50, 200, 500
+
+            # A level ends when the latency and queue depth are below this fraction of its thresholds.
+            # Default is 0.5.
+            recovery = 0.5
+
+            # At level 1 and above, publish one in this many loop packets.
+            # Default is 5.
+            rate_divisor = 5
+
+        [[[message_log]]]
+            # Logging of each published message.
+            # The debug level is checked every check_interval seconds, not for each message,
+            # so when debug is off, logging costs nothing per message.
+            # Log one in this many published and acknowledged messages at debug level.
+            # Default is 1.
+            sample = 1
+
+            # A file of topics, one per line, to trace. It is read when it changes, so tracing can be turned on
+            # and off while WeeWX is running. Each message to a topic starting with one of them is logged,
+            # at info level, as JSON, and so is its acknowledgement.
+            # Default is None, no tracing.
+            trace_file = None
+
+            # The number of seconds between checking the debug level and the trace file.
+            # Default is 10.
+            check_interval = 10
+
+        [[[home_assistant]]]
+            # Publish Home Assistant MQTT discovery payloads for the fields of json and individual topics.
+            # The payloads are published, retained, when a field is first seen and when its payload changes.
+            # They are published again each time the connection is made.
+            # Default is False.
+            enable = False
+
+            # The Home Assistant discovery prefix.
+            # Default is homeassistant.
+            discovery_prefix = homeassistant
+
+            # The id of this station, used in the discovery topics and unique ids.
+            # Default is weewx.
+            node_id = weewx
+
+            # The name of the device in Home Assistant.
+            # Default is WeeWX.
+            device_name = WeeWX
+
+            # The QOS level of the discovery payloads.
+            # Default is 1.
+            qos = 1
+
+        # Publish the payloads of the topics with 'bundle = True' as one message per record, instead of one message each.
+        # The message starts with b'WXB1', then the number of payloads (2 bytes),
+        # then for each payload: the topic length (2 bytes), the topic, the payload offset and the payload length (4 bytes each),
+        # then the payloads. The numbers are big endian. Use user.mqttpublish_util.decode_bundle to read it.
+        # Payloads that are compressed always signal it with the topic suffix.
+        [[[bundle]]]
+            # The topic the bundles are published to.
+            # Default is None, bundling is not used.
+            topic = None
+
+            # The QOS level of the bundles.
+            # Default is 0.
+            qos = 0
+
+            # The MQTT retain flag of the bundles.
+            # Default is False.
+            retain = False
+
+        # Destinations, other than MQTT, that topics can be published to.
+        # When no topic is published to MQTT and there is no monitor_topic, no MQTT connection is made.
+        [[[sinks]]]
+            [[[[sinkName]]]]
+                # socket: newline delimited JSON messages are written to a Unix domain socket.
+                # file: newline delimited JSON messages are appended to a file.
+                # callback: a Python function is called with each message,
+                #           it is called in the publishing process, so use mode = thread to share data with WeeWX.
+                # Each JSON message has the keys dateTime, topic, qos, retain and payload.
+                # A compressed payload is base64 encoded and the key encoding is set to base64.
+                type =
+
+                # The path of the socket or file.
+                path =
+
+                # The file is rotated when it reaches this number of bytes, 0 is never.
+                # Default is 1048576.
+                max_bytes = 1048576
+
+                # The number of rotated files kept.
+                # Default is 5.
+                backup_count = 5
+
+                # The number of seconds to wait before reconnecting to the socket.
+                # Default is 10.
+                retry_interval = 10
+
+                # The number of seconds to wait for the socket's consumer to read, before the connection is closed.
+                # Default is 1.
+                send_timeout = 1
+
+                # The function, module.function, called with time_stamp, qos, retain, topic, payload and properties.
+                callback =
+
         [[[Topics]]]
             [[[[first/topic]]]]
             # Controls if the topic is published.
@@ -85,14 +325,159 @@ Configuration:
             # The default is False.
             retain = False
 
+            # What the topic is published on: loop, archive, or schedule.
+            # A schedule topic is published on the clock, not when data arrives, and not with loop or archive.
+            # Default is the [MQTTPublish] binding.
+            binding = loop
+
+            # When the binding is schedule, the number of seconds between publishing, or a cron specification.
+            # Interval schedules are aligned to the clock, for example 300 publishes at 0, 5, 10... minutes past the hour.
+            # A cron specification has minute, hour, day of month, month and day of week,
+            # each is *, a value, a range a-b, a list a,b or */step. Quote it if it contains commas.
+            # Default is None.
+            schedule = None
+
+            # When the binding is schedule, the data whose last values are published: loop, archive, or none.
+            # With none, only the aggregates are published.
+            # Default is none.
+            schedule_source = none
+
+            # The format of the payload.
+            # Valid values: json, keyword, individual, template
+            # Default is json.
+            type = json
+
+            # The payload template, when the type is template. Quote it if it contains commas.
+            # '{{ name }}' is replaced by the formatted field or aggregate, the name includes any unit label.
+            # '{{ name | json }}' is replaced by the JSON encoding of the value.
+            # '{{ name | default(text) }}' is replaced by text when the field is missing, otherwise it is an empty string.
+            # Default is None.
+            template = None
+
+            # A file containing the payload template, instead of 'template'.
+            # Default is None.
+            template_file = None
+
             # Controls if the unit label is appended to the field name.
             # Default is True.
             append_unit_label = True
 
+            # Controls if Home Assistant discovery payloads are published for the topic's fields.
+            # Only used if [[[home_assistant]]] is enabled, and not for bundled topics.
+            # Default is True.
+            home_assistant = True
+
+            # The publishing queue lane of the topic.
+            # Valid values: archive, guaranteed, loop
+            # Default is archive for archive data, guaranteed if guarantee_delivery is True, otherwise loop.
+            priority =
+
+            # Publish the topic's payloads in the [[[bundle]]], instead of as separate messages.
+            # Default is False.
+            bundle = False
+
+            # Where the topic is published, mqtt or the name of one of the [[[sinks]]].
+            # Default is mqtt.
+            sink = mqtt
+
             # The unit system for data published to this topic.
             # The default is US.
             unit_system = US
 
+            # The following options are only used when the protocol is MQTTv5.
+            # Send the topic once and then a 2 byte alias in its place.
+            # Only applied to QOS 0 messages, because paho resends QOS 1/2 messages as is after a reconnect.
+            # Default is False.
+            topic_alias = False
+
+            # The number of seconds after which the broker discards the message if it has not been delivered.
+            # Default is None, no expiry.
+            message_expiry_interval = None
+
+            # The content type of the payload.
+            # Default is None.
+            content_type = None
+
+            # Additional name/value pairs sent with each message.
+            [[[[[user_properties]]]]]
+                # name = value
+
+            # Compress the payload.
+            # Valid values: none, zlib, gzip, zstd (requires the zstandard package)
+            # Default is none.
+            compression = none
+
+            # Payloads smaller than this number of bytes are not compressed.
+            # Default is 1024.
+            compression_threshold = 1024
+
+            # The compression level, the meaning depends on the compression.
+            # Default is the compression library's default.
+            compression_level =
+
+            # A file containing a preset dictionary, for example a typical payload (zlib) or the output of 'zstd --train' (zstd).
+            # Consumers must decompress with the same dictionary.
+            # Default is None.
+            compression_dictionary = None
+
+            # How a compressed payload is signalled.
+            # content_type: the MQTTv5 content type is set to 'application/<compression>'.
+            # suffix: '/<compression>' is appended to the topic.
+            # When the protocol is not MQTTv5, suffix is always used.
+            # Default is content_type.
+            compression_signal = content_type
+
+            # Keep a rolling history of fields and publish it, retained, with each record.
+            # The payload is JSON with an array per field and a dateTime array, oldest first.
+            # Values are in the topic's unit system, missing values are null.
+            # Bind a topic with a history to loop or archive, not both.
+            [[[[[history]]]]]
+                # The fields kept.
+                # Default is None, no history.
+                fields =
+
+                # The number of values kept.
+                # Default is 720.
+                size = 720
+
+                # Downsample to at most this number of points, averaging the values of each point.
+                # Default is None, all values are published.
+                points = None
+
+                # The number of decimal places values are rounded to.
+                # Default is None, not rounded.
+                decimals = None
+
+                # Publish the history every this number of records.
+                # Default is 1.
+                publish_interval = 1
+
+                # The topic the history is published to.
+                # Default is the topic with '/history' appended.
+                topic =
+
+            # Fields calculated from the other fields of the packet.
+            # A derived field used by several topics is calculated once per packet,
+            # and not again while the fields it depends on are unchanged.
+            # The field options, name, unit, format, etc, can also be set.
+            [[[[[derived]]]]]
+                [[[[[[derivedObservationName]]]]]]
+                    # An expression over other fields, including other derived fields. For example: outTemp - dewpoint
+                    # Arithmetic, comparisons and the functions abs, min, max and round can be used.
+                    expression =
+
+                    # Or the WeeWX xtype to calculate, for example dewpoint, heatindex or windchill.
+                    # Default is the name of the derived field, when there is no expression.
+                    xtype =
+
+                    # The fields the value depends on, the expression's fields are found automatically.
+                    # Default is the fields of known xtypes, otherwise the value is calculated for each packet.
+                    inputs =
+
+                    # The unit group of an expression's value, for example group_temperature.
+                    # Default is None.
+                    unit_group =
+
             # The aggregations to perform
             [[[[[aggregates]]]]]
                 # The name of the observation in the MQTT payload.
@@ -113,24 +498,45 @@ Configuration:
 import queue as Queue
 
 import abc
+import ast
+import collections
 import datetime
+import gzip
+import hashlib
 import json
 import logging
+import multiprocessing
+import os
 import random
+import re
 import ssl
 import threading
 import time
 import traceback
+import uuid
+import zlib
 
 import configobj
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 import weeutil
 from weeutil.weeutil import to_bool, to_float, to_int, TimeSpan
 
 import weewx
+import weewx.manager
+import weewx.xtypes
 from weewx.engine import StdService
 
+from user.mqttpublish_util import AbstractSink, PublishProfiler, RollingHistory, SlidingWindow, TimerWheel, \
+    encode_bundle, get_schedule
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 VERSION = "1.0.0-rc01a"
 
 log = logging.getLogger(__name__)
@@ -161,22 +567,593 @@ period_timespan = {
     'week': lambda time_stamp: weeutil.weeutil.archiveWeekSpan(time_stamp),
     'month': lambda time_stamp: weeutil.weeutil.archiveMonthSpan(time_stamp),
     'year': lambda time_stamp: weeutil.weeutil.archiveYearSpan(time_stamp),
-    'last24hours': lambda time_stamp: TimeSpan(time_stamp, time_stamp - 86400),
-    'last7days': lambda time_stamp: TimeSpan(time_stamp,
-                                             time.mktime((datetime.date.fromtimestamp(time_stamp) -
-                                                          datetime.timedelta(days=7)).timetuple())),
-    'last31days': lambda time_stamp: TimeSpan(time_stamp,
-                                              time.mktime((datetime.date.fromtimestamp(time_stamp) -
-                                                           datetime.timedelta(days=31)).timetuple())),
-    'last366days': lambda time_stamp: TimeSpan(time_stamp,
-                                               time.mktime((datetime.date.fromtimestamp(time_stamp) -
-                                                            datetime.timedelta(days=366)).timetuple()))
+    'last24hours': lambda time_stamp: TimeSpan(time_stamp - 86400, time_stamp),
+    'last7days': lambda time_stamp: TimeSpan(time.mktime((datetime.date.fromtimestamp(time_stamp) -
+                                                          datetime.timedelta(days=7)).timetuple()),
+                                             time_stamp),
+    'last31days': lambda time_stamp: TimeSpan(time.mktime((datetime.date.fromtimestamp(time_stamp) -
+                                                           datetime.timedelta(days=31)).timetuple()),
+                                              time_stamp),
+    'last366days': lambda time_stamp: TimeSpan(time.mktime((datetime.date.fromtimestamp(time_stamp) -
+                                                            datetime.timedelta(days=366)).timetuple()),
+                                               time_stamp)
 }
 
+# The publishing process is forked, so that it has the units and xtypes other extensions registered.
+# Other start methods, the default on some platforms and Python versions, start a fresh interpreter.
+process_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+# The rolling periods, these are calculated with a SlidingWindow
+sliding_periods = ['last24hours', 'last7days', 'last31days', 'last366days']
+
+class PublishQueue():
+    """ A queue with priority lanes that are drained in proportion to their weights.
+
+    Items are put in the lane named by their 'lane' key.
+    A lane is served while it has credit, higher priority lanes first.
+    When no lane with items has credit left, every lane's credit is reset to its weight.
+    """
+    LANES = ['archive', 'guaranteed', 'loop']
+
+    def __init__(self, weights=None):
+        weights = weights or [4, 2, 1]
+        if len(weights) != len(self.LANES):
+            raise ValueError(f"Invalid 'priority_weights', {weights}")
+
+        self.weights = dict(zip(self.LANES, weights))
+        self.credits = dict(self.weights)
+        self.lanes = {lane: collections.deque() for lane in self.LANES}
+        self.mutex = threading.Lock()
+
+    def put(self, item):
+        """ Put an item in its lane. """
+        lane = item.get('lane') or ('archive' if item['type'] == 'archive' else 'loop')
+        with self.mutex:
+            self.lanes[lane].append(item)
+
+    def get_nowait(self):
+        """ Get the next item, raise queue.Empty if there is none. """
+        with self.mutex:
+            lanes = [lane for lane in self.LANES if self.lanes[lane]]
+            if not lanes:
+                raise Queue.Empty
+
+            for lane in lanes:
+                if self.credits[lane] > 0:
+                    break
+            else:
+                self.credits = dict(self.weights)
+                lane = lanes[0]
+
+            self.credits[lane] -= 1
+            return self.lanes[lane].popleft()
+
+    def qsize(self):
+        """ The number of queued items. """
+        with self.mutex:
+            return sum(len(items) for items in self.lanes.values())
+
+    def empty(self):
+        """ True if there are no queued items. """
+        return self.qsize() == 0
+
+class UnitCache():
+    """ Memoize the unit type, unit label and conversion function of an observation.
+
+    Entries are keyed by (unit system, observation, target unit).
+    Entries of an observation are invalidated when its unit group is changed with 'set_unit_group'.
+    """
+    CachedUnit = collections.namedtuple('CachedUnit', ['unit_type', 'unit_group', 'label', 'convert'])
+
+    def __init__(self, unit_reductions):
+        self.unit_reductions = unit_reductions
+        self._cache = {}
+
+    def get(self, unit_system, obs_type, target_unit=None):
+        """ Get the cached unit information, resolving it on first use. """
+        key = (unit_system, obs_type, target_unit)
+        cached_unit = self._cache.get(key)
+        if cached_unit is None:
+            cached_unit = self._resolve(unit_system, obs_type, target_unit)
+            self._cache[key] = cached_unit
+        return cached_unit
+
+    def _resolve(self, unit_system, obs_type, target_unit):
+        (unit_type, unit_group) = weewx.units.getStandardUnitType(unit_system, obs_type)
+        label = self.unit_reductions.get(unit_type, unit_type)
+
+        convert = None
+        if target_unit is not None:
+            if target_unit in weewx.units.complex_conversions:
+                conversion_func = weewx.units.complex_conversions[target_unit]
+            elif unit_type != target_unit:
+                conversion_func = weewx.units.conversionDict[unit_type][target_unit]
+            else:
+                conversion_func = None
+
+            if conversion_func is not None:
+                convert = self._skip_none(conversion_func)
+
+        return UnitCache.CachedUnit(unit_type, unit_group, label, convert)
+
+    @staticmethod
+    def _skip_none(conversion_func):
+        return lambda value: conversion_func(value) if value is not None else None
+
+    def set_unit_group(self, obs_type, unit_group):
+        """ Set the unit group of an observation, invalidating its entries if it changed. """
+        if weewx.units.obs_group_dict.get(obs_type) == unit_group:
+            return
+        weewx.units.obs_group_dict[obs_type] = unit_group
+        self.invalidate(obs_type)
+
+    def invalidate(self, obs_type=None):
+        """ Remove the entries of an observation, or all entries. """
+        if obs_type is None:
+            self._cache.clear()
+            return
+        for key in [key for key in self._cache if key[1] == obs_type]:
+            del self._cache[key]
+
+class CompiledTemplate():
+    """ A payload template that is parsed once and then rendered for each record. """
+    PLACEHOLDER = re.compile(r'{{\s*([^\s|}]+)\s*((?:\|[^|}]*)*)}}')
+    DEFAULT_FILTER = re.compile(r'default\((.*)\)$')
+
+    def __init__(self, template):
+        self.template = template
+        # Alternating literal text and (name, to_json, default) tuples, always starting and ending with text.
+        self.parts = []
+
+        position = 0
+        for match in self.PLACEHOLDER.finditer(template):
+            self.parts.append(template[position:match.start()])
+            self.parts.append(self._parse_placeholder(match.group(1), match.group(2)))
+            position = match.end()
+        self.parts.append(template[position:])
+
+        self.literals = self.parts[0::2]
+        self.placeholders = self.parts[1::2]
+
+    def _parse_placeholder(self, name, filters):
+        to_json = False
+        default = ''
+        for template_filter in [template_filter.strip() for template_filter in filters.split('|')[1:]]:
+            default_match = self.DEFAULT_FILTER.match(template_filter)
+            if template_filter == 'json':
+                to_json = True
+            elif default_match:
+                default = default_match.group(1)
+            else:
+                raise ValueError(f"Invalid template filter, {template_filter}, in '{self.template}'")
+        return name, to_json, default
+
+    def render(self, record):
+        """ Render the template with the values of a record. """
+        rendered = [self.literals[0]]
+        for (name, to_json, default), literal in zip(self.placeholders, self.literals[1:]):
+            if name in record:
+                rendered.append(json.dumps(record[name]) if to_json else str(record[name]))
+            else:
+                rendered.append(default)
+            rendered.append(literal)
+        return ''.join(rendered)
+
+class HomeAssistantDiscovery():
+    """ Build Home Assistant MQTT discovery payloads, tracking them by a hash of their content. """
+    UNITS = {
+        'degree_F': '°F',
+        'degree_C': '°C',
+        'inch': 'in',
+        'mm': 'mm',
+        'cm': 'cm',
+        'inch_per_hour': 'in/h',
+        'mm_per_hour': 'mm/h',
+        'cm_per_hour': 'cm/h',
+        'inHg': 'inHg',
+        'mbar': 'mbar',
+        'hPa': 'hPa',
+        'kPa': 'kPa',
+        'mile_per_hour': 'mph',
+        'mile_per_hour2': 'mph',
+        'km_per_hour': 'km/h',
+        'km_per_hour2': 'km/h',
+        'meter_per_second': 'm/s',
+        'meter_per_second2': 'm/s',
+        'knot': 'kn',
+        'knot2': 'kn',
+        'degree_compass': '°',
+        'percent': '%',
+        'watt_per_meter_squared': 'W/m²',
+        'volt': 'V',
+        'foot': 'ft',
+        'meter': 'm',
+        'mile': 'mi',
+        'km': 'km',
+    }
+    DEVICE_CLASSES = {
+        'group_temperature': 'temperature',
+        'group_pressure': 'atmospheric_pressure',
+        'group_speed': 'wind_speed',
+        'group_speed2': 'wind_speed',
+        'group_rain': 'precipitation',
+        'group_rainrate': 'precipitation_intensity',
+        'group_radiation': 'irradiance',
+        'group_volt': 'voltage',
+        'group_distance': 'distance',
+    }
+
+    def __init__(self, discovery_dict, lwt_dict):
+        self.discovery_prefix = discovery_dict.get('discovery_prefix', 'homeassistant')
+        self.node_id = discovery_dict.get('node_id', 'weewx')
+        self.qos = to_int(discovery_dict.get('qos', 1))
+        self.device = {
+            'identifiers': [self.node_id],
+            'name': discovery_dict.get('device_name', 'WeeWX'),
+            'manufacturer': 'WeeWX',
+            'sw_version': weewx.__version__,
+        }
+        self.availability = None
+        if lwt_dict:
+            self.availability = {
+                'availability_topic': lwt_dict.get('topic', 'status'),
+                'payload_available': lwt_dict.get('online_payload', 'online'),
+                'payload_not_available': lwt_dict.get('offline_payload', 'offline'),
+            }
+
+        # The discovery topic and payload of each sensor.
+        self.payloads = {}
+        self.hashes = {}
+        # The fields each topic had when its discovery payloads were last checked.
+        self.topic_fields = {}
+
+    def get_payload(self, topic, topic_type, name, unit, unit_group):
+        """ Get the discovery topic and payload of a sensor. """
+        object_id = re.sub(r'[^a-zA-Z0-9_-]', '_', f"{topic}_{name}")
+        config = {
+            'name': name,
+            'unique_id': f"{self.node_id}_{object_id}",
+            'object_id': f"{self.node_id}_{object_id}",
+            'device': self.device,
+        }
+        if topic_type == 'individual':
+            config['state_topic'] = f"{topic}/{name}"
+        else:
+            config['state_topic'] = topic
+            config['value_template'] = f"{{{{ value_json['{name}'] }}}}"
+        if unit in self.UNITS:
+            config['unit_of_measurement'] = self.UNITS[unit]
+            config['state_class'] = 'measurement'
+        if unit_group in self.DEVICE_CLASSES:
+            config['device_class'] = self.DEVICE_CLASSES[unit_group]
+        if self.availability:
+            config.update(self.availability)
+
+        return f"{self.discovery_prefix}/sensor/{self.node_id}/{object_id}/config", json.dumps(config, sort_keys=True)
+
+    def update(self, topic, topic_type, sensors):
+        """ Update the payloads of a topic's sensors, returning the ones that changed.
+
+        sensors is a list of (name, unit, unit group) tuples.
+        """
+        changed = []
+        for (name, unit, unit_group) in sensors:
+            (discovery_topic, payload) = self.get_payload(topic, topic_type, name, unit, unit_group)
+            payload_hash = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+            if self.hashes.get(discovery_topic) != payload_hash:
+                self.hashes[discovery_topic] = payload_hash
+                self.payloads[discovery_topic] = payload
+                changed.append((discovery_topic, payload))
+
+        return changed
+
+class DerivedFields():
+    """ Calculate derived fields once per packet, in dependency order.
+
+    definitions is a dictionary of name to definition, in dependency order.
+    A value is only recalculated when the values of its inputs change.
+    """
+    FUNCTIONS = {'abs': abs, 'min': min, 'max': max, 'round': round}
+    EXPRESSION_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call,
+                        ast.Name, ast.Load, ast.Constant, ast.operator, ast.unaryop, ast.boolop, ast.cmpop)
+    # The inputs of xtypes that WeeWX calculates from the packet
+    XTYPE_INPUTS = {
+        'dewpoint': ['outTemp', 'outHumidity'],
+        'inDewpoint': ['inTemp', 'inHumidity'],
+        'heatindex': ['outTemp', 'outHumidity'],
+        'humidex': ['outTemp', 'outHumidity'],
+        'windchill': ['outTemp', 'windSpeed'],
+        'appTemp': ['outTemp', 'outHumidity', 'windSpeed'],
+        'cloudbase': ['outTemp', 'outHumidity'],
+        'windrun': ['windSpeed', 'interval'],
+    }
+
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self.code = {}
+        for name, definition in definitions.items():
+            if definition.get('expression') is not None:
+                self.code[name] = compile(self.parse(definition['expression']), f"<derived {name}>", 'eval')
+            if definition.get('unit_group') is not None:
+                PublishWeeWXThread.unit_cache.set_unit_group(name, definition['unit_group'])
+
+        # Each field, with the derived fields it depends on
+        self.required = {}
+        for name, definition in definitions.items():
+            self.required[name] = {name}
+            for input_name in definition['inputs'] or []:
+                self.required[name] |= self.required.get(input_name, set())
+
+        # The previous inputs and value of each field
+        self.inputs = {}
+        self.values = {}
+
+    @classmethod
+    def parse(cls, expression):
+        """ Parse an expression, allowing only simple arithmetic. """
+        tree = ast.parse(expression, mode='eval')
+        for node in ast.walk(tree):
+            if not isinstance(node, cls.EXPRESSION_NODES):
+                raise ValueError(f"Invalid 'expression', {expression}")
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.func.id not in cls.FUNCTIONS):
+                raise ValueError(f"Invalid function in 'expression', {expression}")
+        return tree
+
+    @classmethod
+    def get_inputs(cls, name, derived_dict):
+        """ Get the names of the fields a derived field depends on, None if unknown. """
+        if derived_dict.get('expression') is not None:
+            tree = cls.parse(derived_dict['expression'])
+            inputs = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)} - set(cls.FUNCTIONS)
+            # The configured inputs add to the expression's fields
+            inputs.update(weeutil.weeutil.option_as_list(derived_dict.get('inputs')) or [])
+            return sorted(inputs)
+        if derived_dict.get('inputs') is not None:
+            return weeutil.weeutil.option_as_list(derived_dict['inputs'])
+        return cls.XTYPE_INPUTS.get(derived_dict.get('xtype', name))
+
+    @staticmethod
+    def sort(definitions):
+        """ Sort the definitions so that each comes after the derived fields it depends on. """
+        sorted_definitions = {}
+        visiting = set()
+
+        def visit(name):
+            if name in sorted_definitions:
+                return
+            if name in visiting:
+                raise ValueError(f"Derived field '{name}' depends on itself.")
+            visiting.add(name)
+            for input_name in definitions[name]['inputs'] or []:
+                if input_name in definitions:
+                    visit(input_name)
+            visiting.discard(name)
+            sorted_definitions[name] = definitions[name]
+
+        for name in definitions:
+            visit(name)
+        return sorted_definitions
+
+    def calculate(self, record, names, db_manager=None):
+        """ Calculate the derived fields in 'names', and the ones they depend on. """
+        required = set().union(*(self.required[name] for name in names))
+        values = {}
+        for name, definition in self.definitions.items():
+            if name not in required:
+                continue
+            fields = dict(record, **values)
+
+            inputs = None
+            if definition['inputs'] is not None:
+                inputs = tuple(fields.get(input_name) for input_name in definition['inputs'])
+                if name in self.values and self.inputs.get(name) == inputs:
+                    values[name] = self.values[name]
+                    continue
+
+            values[name] = self._calculate(name, definition, fields, db_manager)
+            self.inputs[name] = inputs
+            self.values[name] = values[name]
+
+        return values
+
+    def _calculate(self, name, definition, fields, db_manager):
+        if name in self.code:
+            if any(fields.get(input_name) is None for input_name in definition['inputs']):
+                return None
+            try:
+                return eval(self.code[name], {'__builtins__': {}}, dict(fields, **self.FUNCTIONS))  # pylint: disable=eval-used
+            except (ArithmeticError, NameError, TypeError, ValueError) as exception:
+                logerr(f"Calculating '{name}' failed: {exception}")
+                return None
+
+        try:
+            value_tuple = weewx.xtypes.get_scalar(definition.get('xtype') or name, fields, db_manager)
+            return weewx.units.convertStd(value_tuple, fields['usUnits'])[0]
+        except (weewx.CannotCalculate, weewx.UnknownType, weewx.NoCalculate):
+            return None
+
+class LoadController():
+    """ Choose how much to degrade loop publishing, from the acknowledgement latency and queue depth. """
+    MAX_LEVEL = 3
+
+    def __init__(self, load_shedding_dict):
+        self.latency_thresholds = [to_float(threshold) for threshold in
+                                   weeutil.weeutil.option_as_list(load_shedding_dict.get('latency_thresholds', [0.5, 2, 5]))]
+        self.queue_thresholds = [to_int(threshold) for threshold in
+                                 weeutil.weeutil.option_as_list(load_shedding_dict.get('queue_thresholds', [50, 200, 500]))]
+        if len(self.latency_thresholds) != self.MAX_LEVEL or len(self.queue_thresholds) != self.MAX_LEVEL:
+            raise ValueError("Three 'latency_thresholds' and 'queue_thresholds' are required.")
+        self.recovery = to_float(load_shedding_dict.get('recovery', 0.5))
+        self.rate_divisor = to_int(load_shedding_dict.get('rate_divisor', 5))
+
+        self.level = 0
+        self.packets = 0
+
+    def _over(self, level, latency, queue_depth, factor=1.0):
+        return latency >= self.latency_thresholds[level - 1] * factor or queue_depth >= self.queue_thresholds[level - 1] * factor
+
+    def update(self, latency, queue_depth):
+        """ Update the level. Levels go up as soon as a threshold is reached, and down once under the recovery point. """
+        level = self.level
+        while level < self.MAX_LEVEL and self._over(level + 1, latency, queue_depth):
+            level += 1
+        while level > 0 and not self._over(level, latency, queue_depth, self.recovery):
+            level -= 1
+
+        if level != self.level:
+            if level > self.level:
+                logerr(f"Degrading loop publishing to level {level}, latency {latency:.3f}s, queue depth {queue_depth}.")
+            else:
+                loginf(f"Restoring loop publishing to level {level}, latency {latency:.3f}s, queue depth {queue_depth}.")
+            self.level = level
+        return self.level
+
+    def admit(self):
+        """ True if this loop packet should be published at the current level. """
+        self.packets += 1
+        return self.level == 0 or self.packets % self.rate_divisor == 0
+
+    def filter_topics(self, topics):
+        """ Remove the topics that are not published at the current level. """
+        if self.level < 3:
+            return topics
+        return {topic: topic_dict for (topic, topic_dict) in topics.items() if topic_dict['type'] != 'individual'}
+
+class PayloadCompressor():
+    """ Compress payloads that are at least 'threshold' bytes. """
+    def __init__(self, name, threshold=1024, level=None, dictionary=None, signal='content_type'):
+        if name not in ['zlib', 'gzip', 'zstd']:
+            raise ValueError(f"Invalid 'compression', {name}")
+        if name == 'zstd' and zstandard is None:
+            raise ValueError("'compression' of zstd requires the zstandard package.")
+        if name == 'gzip' and dictionary is not None:
+            raise ValueError("'compression_dictionary' is not supported by gzip.")
+        if signal not in ['content_type', 'suffix']:
+            raise ValueError(f"Invalid 'compression_signal', {signal}")
+
+        self.name = name
+        self.threshold = threshold
+        self.level = level
+        self.dictionary = dictionary
+        self.signal = signal
+        self.content_type = f"application/{name}"
+        self._zstd_compressor = None
+
+    def __getstate__(self):
+        # The zstandard compressor cannot be pickled, it is recreated on first use.
+        state = self.__dict__.copy()
+        state['_zstd_compressor'] = None
+        return state
+
+    def compress(self, payload):
+        """ Return the compressed payload, or None if it is below the threshold. """
+        if not isinstance(payload, bytes):
+            payload = str(payload).encode('utf-8')
+        if len(payload) < self.threshold:
+            return None
+
+        if self.name == 'zlib':
+            level = self.level if self.level is not None else zlib.Z_DEFAULT_COMPRESSION
+            if self.dictionary is None:
+                return zlib.compress(payload, level)
+            compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, zdict=self.dictionary)
+            return compressor.compress(payload) + compressor.flush()
+
+        if self.name == 'gzip':
+            level = self.level if self.level is not None else 9
+            return gzip.compress(payload, compresslevel=level, mtime=0)
+
+        if self._zstd_compressor is None:
+            dict_data = zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary is not None else None
+            self._zstd_compressor = zstandard.ZstdCompressor(level=self.level if self.level is not None else 3,
+                                                             dict_data=dict_data)
+        return self._zstd_compressor.compress(payload)
+
+class MessageLog():
+    """ Debug and trace logging of each published message, that costs one attribute check when it is off. """
+    def __init__(self, message_log_dict):
+        self.sample = max(to_int(message_log_dict.get('sample', 1)), 1)
+        self.trace_file = message_log_dict.get('trace_file', None)
+        self.check_interval = to_float(message_log_dict.get('check_interval', 10))
+
+        self.debug = False
+        self.trace_topics = ()
+        # The publish time of each traced message
+        self.traced = {}
+        self.published_count = 0
+        self.acknowledged_count = 0
+        self.trace_mtime = None
+        self.last_check = None
+        # True if anything is logged per message
+        self.enabled = False
+        self.check(time.time())
+
+    def check(self, now):
+        """ Check the debug level and the trace file, at most every check_interval seconds. """
+        if self.last_check is not None and now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        self.debug = log.isEnabledFor(logging.DEBUG)
+        if self.trace_file is not None:
+            self.read_trace_file()
+        self.enabled = self.debug or bool(self.trace_topics)
+
+    def read_trace_file(self):
+        """ Read the topics to trace, if the file has changed. """
+        try:
+            mtime = os.stat(self.trace_file).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.trace_mtime:
+            return
+        self.trace_mtime = mtime
+
+        topics = []
+        if mtime is not None:
+            with open(self.trace_file, encoding='UTF-8') as file_object:
+                topics = [line.strip() for line in file_object if line.strip() and not line.startswith('#')]
+        if topics:
+            loginf(f"Tracing topics {topics}")
+        elif self.trace_topics:
+            loginf("Tracing is off")
+        self.trace_topics = tuple(topics)
+        if not self.trace_topics:
+            self.traced = {}
+
+    def published(self, time_stamp, mid, qos, retain, topic, data):
+        """ Log a published message. """
+        if self.trace_topics and topic.startswith(self.trace_topics):
+            now = time.time()
+            self.traced[mid] = now
+            loginf(json.dumps({'trace': 'publish', 'time': round(now, 3), 'dateTime': int(time_stamp), 'mid': mid,
+                               'qos': qos, 'retain': retain, 'topic': topic,
+                               'bytes': len(data) if isinstance(data, (str, bytes)) else None}))
+        if self.debug:
+            self.published_count += 1
+            if self.published_count % self.sample == 0:
+                logdbg(f"Publishing ({int(time.time())}): {int(time_stamp)} {mid} {qos} {topic}")
+
+    def acknowledged(self, mid):
+        """ Log an acknowledged message. """
+        publish_time = self.traced.pop(mid, None)
+        if publish_time is not None:
+            now = time.time()
+            loginf(json.dumps({'trace': 'acknowledge', 'time': round(now, 3), 'mid': mid,
+                               'latency': round(now - publish_time, 3)}))
+        if self.debug:
+            self.acknowledged_count += 1
+            if self.acknowledged_count % self.sample == 0:
+                logdbg(f"Published  ({int(time.time())}): {mid}")
+
 class AbstractPublisher(abc.ABC):
     """ Managing publishing to MQTT. """
     def __init__(self, publisher, mqtt_config):
         self.connected = False
+        # The publish time of each unacknowledged QOS 1/2 message
+        self.inflight = {}
+        self.ack_latency = 0.0
+        self.topic_aliases = {}
+        self.topic_alias_maximum = 0
         self.mqtt_logger = {
             mqtt.MQTT_LOG_INFO: loginf,
             mqtt.MQTT_LOG_NOTICE: loginf,
@@ -187,6 +1164,7 @@ class AbstractPublisher(abc.ABC):
 
         self.publisher = publisher
         self.mqtt_config = mqtt_config
+        self.message_log = MessageLog(mqtt_config.get('message_log') or {})
 
         self.client = self.get_client(mqtt_config['clientid'], mqtt_config['protocol'])
         self.set_callbacks(mqtt_config['log_mqtt'])
@@ -228,12 +1206,15 @@ class AbstractPublisher(abc.ABC):
         retries = 0
         # loop seems to break before connect, perhaps due to logging
         self.client.loop(timeout=0.1)
-        time.sleep(1)
+        if self.publisher.shutdown_event.wait(1):
+            return
         while not self.connected:
             logdbg("waiting")
             # loop seems to break before connect, perhaps due to logging
             self.client.loop(timeout=0.1)
-            time.sleep(5)
+            # Do not keep WeeWX waiting when it is shutting down
+            if self.publisher.shutdown_event.wait(5):
+                return
 
             retries += 1
             if retries > self.mqtt_config['max_retries']:
@@ -258,6 +1239,8 @@ class AbstractPublisher(abc.ABC):
         while not self.connected:
             logdbg("waiting")
             self.client.loop(timeout=5.0)
+            if self.publisher.shutdown_event.is_set():
+                return
 
             retries += 1
             if retries > self.mqtt_config['max_retries']:
@@ -325,15 +1308,106 @@ class AbstractPublisher(abc.ABC):
                             tls_version=tls_version,
                             ciphers=tls_dict.get('ciphers'))
 
-    def publish_message(self, time_stamp, qos, retain, topic, data):
+    def get_properties(self, topic, qos, properties):
+        """ Get the MQTTv5 properties and the topic to publish to. """
+        mqtt_properties = Properties(PacketTypes.PUBLISH)
+        if properties.get('message_expiry_interval') is not None:
+            mqtt_properties.MessageExpiryInterval = properties['message_expiry_interval']
+        if properties.get('content_type') is not None:
+            mqtt_properties.ContentType = properties['content_type']
+        if properties.get('user_properties'):
+            mqtt_properties.UserProperty = properties['user_properties']
+
+        # Aliases only live as long as the connection, and paho resends unacknowledged QOS 1/2 messages as is.
+        # So only alias QOS 0 messages.
+        if properties.get('topic_alias') and qos == 0:
+            alias = self.topic_aliases.get(topic)
+            if alias is not None:
+                mqtt_properties.TopicAlias = alias
+                topic = ''
+            elif len(self.topic_aliases) < self.topic_alias_maximum:
+                alias = len(self.topic_aliases) + 1
+                self.topic_aliases[topic] = alias
+                mqtt_properties.TopicAlias = alias
+
+        if mqtt_properties.isEmpty():
+            return topic, None
+
+        return topic, mqtt_properties
+
+    def publish_message(self, time_stamp, qos, retain, topic, data, properties=None):
         """ Publish the message. """
         if not self.connected:
             self._reconnect()
-        mqtt_message_info = self.client.publish(topic, data, qos=qos, retain=retain)
-        logdbg(f"Publishing ({int(time.time())}): {int(time_stamp)} {mqtt_message_info.mid} {qos} {topic}")
+
+        mqtt_properties = None
+        publish_topic = topic
+        if properties and self.mqtt_config['protocol'] == mqtt.MQTTv5:
+            publish_topic, mqtt_properties = self.get_properties(topic, qos, properties)
+
+        mqtt_message_info = self.client.publish(publish_topic, data, qos=qos, retain=retain, properties=mqtt_properties)
+        if qos > 0:
+            self.inflight[mqtt_message_info.mid] = time.time()
+        if self.message_log.enabled:
+            self.message_log.published(time_stamp, mqtt_message_info.mid, qos, retain, topic, data)
 
         self.client.loop(timeout=0.1)
 
+    def acknowledged(self, mid):
+        """ Record that the broker acknowledged a message. """
+        if self.message_log.enabled:
+            self.message_log.acknowledged(mid)
+        publish_time = self.inflight.pop(mid, None)
+        if publish_time is not None:
+            # Exponentially weighted, so that a single slow acknowledgement does not dominate
+            self.ack_latency = 0.8 * self.ack_latency + 0.2 * (time.time() - publish_time)
+
+    def get_ack_latency(self):
+        """ The acknowledgement latency, or the age of the oldest unacknowledged message if that is longer. """
+        if not self.inflight:
+            return self.ack_latency
+        return max(self.ack_latency, time.time() - min(self.inflight.values()))
+
+    def check_session(self, session_present):
+        """ Log whether the broker resumed the session. """
+        if not self.mqtt_config.get('persistent_session'):
+            return
+        if session_present:
+            loginf(f"Resumed the session, {len(self.inflight)} messages are waiting for acknowledgement.")
+        else:
+            loginf("The broker has no session, a new one was started.")
+
+    def publish_discovery(self):
+        """ Publish the known Home Assistant discovery payloads. """
+        discovery = self.publisher.discovery
+        if discovery is None:
+            return
+        for discovery_topic, payload in discovery.payloads.items():
+            self.client.publish(topic=discovery_topic, payload=payload, qos=discovery.qos, retain=True)
+
+    def wait_for_acknowledgements(self, deadline):
+        """ Wait until the broker has acknowledged the QOS 1/2 messages, or the deadline is reached. """
+        while self.inflight and self.connected and time.time() < deadline:
+            self.client.loop(timeout=0.1)
+
+        if self.inflight:
+            logerr(f"{len(self.inflight)} messages were not acknowledged by the broker.")
+
+    def disconnect(self, deadline):
+        """ Publish the offline payload and disconnect. """
+        if not self.connected:
+            return
+
+        # The will is only sent for an unexpected disconnect, so publish the offline payload.
+        if self.lwt_dict:
+            self.client.publish(topic=self.lwt_dict.get('topic', 'status'),
+                                payload=self.lwt_dict.get('offline_payload', 'offline'),
+                                qos=to_int(self.lwt_dict.get('qos', 0)),
+                                retain=to_bool(self.lwt_dict.get('retain', True)))
+        self.client.disconnect()
+        while self.connected and time.time() < deadline:
+            self.client.loop(timeout=0.1)
+
     def get_client(self, client_id, protocol):
         ''' Get the MQTT client. '''
         raise NotImplementedError("Method 'get_client' is not implemented")
@@ -357,7 +1431,9 @@ class PublisherV1(AbstractPublisher):
 
     def get_client(self, client_id, protocol):
         ''' Get the MQTT client. '''
-        return mqtt.Client(client_id=client_id, protocol=protocol)
+        return mqtt.Client(client_id=client_id,
+                           clean_session=not self.mqtt_config.get('persistent_session', False),
+                           protocol=protocol)
 
     def set_callbacks(self, log_mqtt):
         ''' Setup the MQTT callbacks. '''
@@ -389,11 +1465,13 @@ class PublisherV1(AbstractPublisher):
         # 6-255: Currently unused.
         loginf(f"Connected with result code {int(rc)}, {mqtt.error_string(rc)}")
         loginf(f"Connected flags {str(flags)}")
+        self.check_session(flags.get('session present'))
         if self.lwt_dict:
             self.client.publish(topic=self.lwt_dict.get('topic', 'status'),
                                 payload=self.lwt_dict.get('online_payload', 'online'),
                                 qos=to_int(self.lwt_dict.get('qos', 0)),
                                 retain=to_bool(self.lwt_dict.get('retain', True)))
+        self.publish_discovery()
         self.connected = True
 
     def on_disconnect(self, _client, _userdata, rc):
@@ -415,9 +1493,7 @@ class PublisherV1(AbstractPublisher):
 
     def on_publish(self, _client, _userdata, mid):
         """ The on_publish callback. """
-        time_stamp = "          "
-        qos = ""
-        logdbg(f"Published  ({int(time.time())}): {time_stamp} {mid} {qos}")
+        self.acknowledged(mid)
 
 class PublisherV2(AbstractPublisher):
     ''' MQTTPublish that communicates with paho mqtt v2. '''
@@ -438,21 +1514,33 @@ class PublisherV2(AbstractPublisher):
 
     def connect(self, host, port, keepalive):
         ''' Connect to the MQTT server. '''
-        self.client.connect(host=host, port=port, keepalive=keepalive, clean_start=True)
+        if not self.mqtt_config.get('persistent_session', False):
+            self.client.connect(host=host, port=port, keepalive=keepalive, clean_start=True)
+            return
+
+        # The session is kept for the expiry interval after the connection is lost
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.mqtt_config['session_expiry_interval']
+        self.client.connect(host=host, port=port, keepalive=keepalive, clean_start=False, properties=properties)
 
     def on_log(self, _client, _userdata, level, msg):
         """ The on_log callback. """
         self.mqtt_logger[level](f"MQTT log: {msg}")
 
-    def on_connect(self, _client, _userdata, flags, reason_code, _properties):
+    def on_connect(self, _client, _userdata, flags, reason_code, properties):
         """ The on_connect callback. """
         loginf(f"Connected with result code {int(int(reason_code.value))}")
         loginf(f"Connected flags {str(flags)}")
+        self.check_session(flags.session_present)
+        # Topic aliases are per connection, the broker tells us how many it will accept.
+        self.topic_aliases = {}
+        self.topic_alias_maximum = getattr(properties, 'TopicAliasMaximum', 0)
         if self.lwt_dict:
             self.client.publish(topic=self.lwt_dict.get('topic', 'status'),
                                 payload=self.lwt_dict.get('online_payload', 'online'),
                                 qos=to_int(self.lwt_dict.get('qos', 0)),
                                 retain=to_bool(self.lwt_dict.get('retain', True)))
+        self.publish_discovery()
         self.connected = True
 
     def on_disconnect(self, _client, _userdata, _flags, reason_code, _properties):
@@ -475,9 +1563,7 @@ class PublisherV2(AbstractPublisher):
 
     def on_publish(self, _client, _userdata, mid, _reason_codes, _properties):
         """ The on_publish callback. """
-        time_stamp = "          "
-        qos = ""
-        logdbg(f"Published  ({int(time.time())}): {time_stamp} {mid} {qos}")
+        self.acknowledged(mid)
 
 class PublisherV2MQTT3(PublisherV2):
     ''' MQTTPublish that communicates with paho mqtt v2. '''
@@ -486,7 +1572,7 @@ class PublisherV2MQTT3(PublisherV2):
         return mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
                            protocol=protocol,
                            client_id=client_id,
-                           clean_session=True)
+                           clean_session=not self.mqtt_config.get('persistent_session', False))
 
     def connect(self, host, port, keepalive):
         ''' Connect to the MQTT server. '''
@@ -512,8 +1598,9 @@ class MQTTPublish(StdService):
 
         exclude_keys = ['password']
         sanitized_service_dict = {k: service_dict[k] for k in set(list(service_dict.keys())) - set(exclude_keys)}
-        logdbg(f"sanitized configuration removed {exclude_keys}")
-        logdbg(f"sanitized_service_dict is {sanitized_service_dict}")
+        if log.isEnabledFor(logging.DEBUG):
+            logdbg(f"sanitized configuration removed {exclude_keys}")
+            logdbg(f"sanitized_service_dict is {sanitized_service_dict}")
 
         #  backwards compatability
         if 'PublishWeeWX' in service_dict.sections:
@@ -525,6 +1612,8 @@ class MQTTPublish(StdService):
             loginf("Not enabled, exiting.")
             return
 
+        self.derived_fields = {}
+        self.topics_schedule = {}
         self.topics_loop, self.topics_archive = self.configure_topics(service_dict)
 
         self.mqtt_config = {}
@@ -532,38 +1621,158 @@ class MQTTPublish(StdService):
         self.mqtt_config['keepalive'] = to_int(service_dict.get('keepalive', 60))
 
         self.mqtt_config['max_retries'] = to_int(service_dict.get('max_retries', 5))
+        self.mqtt_config['archive_batch_size'] = to_int(service_dict.get('archive_batch_size', 100))
+        self.mqtt_config['shutdown_timeout'] = to_float(service_dict.get('shutdown_timeout', 20))
+        self.mqtt_config['spool'] = service_dict.get('spool', None)
         self.mqtt_config['log_mqtt'] = to_bool(service_dict.get('log', False))
         self.mqtt_config['host'] = service_dict.get('host', 'localhost')
         self.mqtt_config['port'] = to_int(service_dict.get('port', 1883))
         self.mqtt_config['username'] = service_dict.get('username', None)
         self.mqtt_config['password'] = service_dict.get('password', None)
-        self.mqtt_config['clientid'] = service_dict.get('clientid', 'MQTTPublish-' + str(random.randint(1000, 9999)))
+        self.mqtt_config['persistent_session'] = to_bool(service_dict.get('persistent_session', False))
+        self.mqtt_config['session_expiry_interval'] = to_int(service_dict.get('session_expiry_interval', 3600))
+        self.mqtt_config['clientid'] = self.configure_clientid(service_dict, config_dict)
+        self.clientid = self.mqtt_config['clientid']
 
         protocol_string = service_dict.get('protocol', 'MQTTv311')
         self.mqtt_config['protocol'] = getattr(mqtt, protocol_string, 0)
 
+        # The database is only needed to calculate aggregates
+        self.mqtt_config['data_binding'] = service_dict.get('data_binding', 'wx_binding')
+        self.mqtt_config['db_config'] = None
+        if any(topic_dict['aggregates'] for topic_dict in self.get_topic_dicts()):
+            self.mqtt_config['db_config'] = configobj.ConfigObj({
+                key: config_dict[key] for key in ['WEEWX_ROOT', 'DataBindings', 'Databases', 'DatabaseTypes']
+                if key in config_dict})
+
+        self.mqtt_config['home_assistant'] = service_dict.get('home_assistant', {})
+        self.mqtt_config['profile'] = service_dict.get('profile', {})
+        self.mqtt_config['load_shedding'] = service_dict.get('load_shedding', {})
+        self.mqtt_config['sinks'] = service_dict.get('sinks', {})
+        self.mqtt_config['message_log'] = service_dict.get('message_log', {})
+        self.mqtt_config['topics_schedule'] = self.topics_schedule
+        bundle_dict = service_dict.get('bundle', {})
+        self.mqtt_config['bundle'] = None
+        if bundle_dict.get('topic') is not None:
+            self.mqtt_config['bundle'] = {
+                'topic': bundle_dict['topic'],
+                'qos': to_int(bundle_dict.get('qos', 0)),
+                'retain': to_bool(bundle_dict.get('retain', False)),
+            }
+        self.mqtt_config['derived'] = DerivedFields.sort(self.derived_fields)
+
+        watchdog_dict = service_dict.get('watchdog', {})
+        self.watchdog = {
+            'stall_timeout': to_float(watchdog_dict.get('stall_timeout', None)),
+            'stall_action': watchdog_dict.get('stall_action', 'restart'),
+            'max_lag': to_float(watchdog_dict.get('max_lag', None)),
+            'lag_action': watchdog_dict.get('lag_action', 'shed'),
+        }
+        for action in ['stall_action', 'lag_action']:
+            if self.watchdog[action] not in ['restart', 'shed', 'kill_weewx']:
+                raise ValueError(f"Invalid '{action}', {self.watchdog[action]}")
+        self.shedding = False
+        self.mqtt_config['monitor_topic'] = watchdog_dict.get('monitor_topic', None)
+        self.mqtt_config['monitor_interval'] = to_float(watchdog_dict.get('monitor_interval', 60))
+
         self.mqtt_config['tls'] = service_dict.get('tls')
         self.mqtt_config['lwt'] = service_dict.get('lwt')
 
-        # todo - make configurable
-        self.kill_weewx = []
-        self.max_thread_restarts = 2
-        self.thread_restarts = 0
+        self.kill_weewx = weeutil.weeutil.option_as_list(service_dict.get('kill_weewx', []))
+        self.max_restarts = to_int(service_dict.get('max_restarts', 2))
+        self.restarts = 0
 
         # todo, tie this into the topic bindings somehow...
         binding = weeutil.weeutil.option_as_list(service_dict.get('binding', ['archive', 'loop']))
 
-        self.data_queue = Queue.Queue()
-
-        if 'loop' in binding:
+        self.mqtt_config['priority_weights'] = \
+            [to_int(weight) for weight in weeutil.weeutil.option_as_list(service_dict.get('priority_weights', [4, 2, 1]))]
+
+        self.mode = service_dict.get('mode', 'thread')
+        if self.mode == 'thread':
+            self.data_queue = PublishQueue(self.mqtt_config['priority_weights'])
+        elif self.mode == 'process':
+            if process_context is None:
+                raise ValueError("'mode = process' requires processes to be forked, which this platform does not support.")
+            self.data_queue = process_context.Queue()
+            self.logging_config = configobj.ConfigObj({
+                'debug': config_dict.get('debug', 0),
+                'Logging': config_dict.get('Logging', {}),
+            })
+        else:
+            raise ValueError(f"Invalid 'mode', {self.mode}")
+        self.lanes = {
+            'loop': [lane for lane in PublishQueue.LANES
+                     if any(topic_dict['priority'] == lane for topic_dict in self.topics_loop.values())],
+            'archive': [lane for lane in PublishQueue.LANES
+                        if any(topic_dict['priority'] == lane for topic_dict in self.topics_archive.values())],
+        }
+        # The thread keeps the last data of the schedule topics' source
+        for data_type in ['loop', 'archive']:
+            if self.needs_source(data_type) and not self.lanes[data_type]:
+                self.lanes[data_type].append(data_type)
+        self.load_spool()
+        self.accepting = True
+
+        if 'loop' in binding or self.needs_source('loop'):
             self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
 
-        if 'archive' in binding:
+        # The rolling period aggregates are updated from the archive records
+        if self.has_sliding_aggregates() and 'archive' not in self.lanes['archive']:
+            self.lanes['archive'].insert(0, 'archive')
+
+        if 'archive' in binding or self.has_sliding_aggregates() or self.needs_source('archive'):
             self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
 
-        self._thread = PublishWeeWXThread(self.mqtt_config, self.topics_loop, self.topics_archive, self.data_queue)
+        self._thread = self.get_worker()
         self.thread_start()
 
+    def has_sliding_aggregates(self):
+        """ True if an aggregate is over a rolling period. """
+        return any(aggregate['period'] in sliding_periods
+                   for topic_dict in self.get_topic_dicts()
+                   for aggregate in topic_dict['aggregates'].values())
+
+    def configure_clientid(self, service_dict, config_dict):
+        """ Get the clientid, a persistent session needs the same one each time. """
+        clientid = service_dict.get('clientid', None)
+        if clientid:
+            return clientid
+        if not self.mqtt_config['persistent_session']:
+            return 'MQTTPublish-' + str(random.randint(1000, 9999))
+
+        clientid_file = os.path.join(config_dict.get('WEEWX_ROOT', ''),
+                                     service_dict.get('clientid_file', 'mqttpublish.clientid'))
+        if os.path.exists(clientid_file):
+            with open(clientid_file, encoding='UTF-8') as file_object:
+                clientid = file_object.read().strip()
+        if not clientid:
+            # Two stations with the same clientid would take over each other's session, so it must be unique
+            clientid = 'MQTTPublish-' + uuid.uuid4().hex
+            with open(clientid_file, 'w', encoding='UTF-8') as file_object:
+                file_object.write(clientid + '\n')
+            loginf(f"Saved clientid {clientid} to {clientid_file}")
+        return clientid
+
+    def get_topic_dicts(self):
+        """ Get the configuration of every topic, loop, archive and schedule. """
+        return list(self.topics_loop.values()) + list(self.topics_archive.values()) + list(self.topics_schedule.values())
+
+    def needs_source(self, data_type):
+        """ True if a schedule topic publishes the last values of the data type. """
+        return any(topic_dict['schedule_source'] == data_type for topic_dict in self.topics_schedule.values())
+
+    def get_worker(self):
+        """ Get the thread or process that publishes. """
+        if self.mode == 'process':
+            return PublishWeeWXProcess(self.mqtt_config,
+                                       self.topics_loop,
+                                       self.topics_archive,
+                                       self.data_queue,
+                                       self.logging_config)
+
+        return PublishWeeWXThread(self.mqtt_config, self.topics_loop, self.topics_archive, self.data_queue)
+
     def configure_fields(self,
                          fields_dict,
                          ignore,
@@ -587,10 +1796,94 @@ class MQTTPublish(StdService):
         # logdbg("Configured fields: %s" % fields)
         return fields
 
+    @staticmethod
+    def configure_history(topic, topic_dict):
+        """ Configure the rolling history of a topic. """
+        history_dict = topic_dict.get('history', {})
+        fields = weeutil.weeutil.option_as_list(history_dict.get('fields', None))
+        if not fields:
+            return None
+
+        return {
+            'fields': fields,
+            'size': to_int(history_dict.get('size', 720)),
+            'points': to_int(history_dict.get('points', None)),
+            'decimals': to_int(history_dict.get('decimals', None)),
+            'publish_interval': to_int(history_dict.get('publish_interval', 1)),
+            'topic': history_dict.get('topic', f"{topic}/history"),
+        }
+
+    @staticmethod
+    def configure_properties(topic_dict, service_dict):
+        """ Configure the MQTTv5 publish properties. """
+        properties = {}
+        properties['topic_alias'] = to_bool(topic_dict.get('topic_alias', service_dict.get('topic_alias', False)))
+        properties['message_expiry_interval'] = \
+            to_int(topic_dict.get('message_expiry_interval', service_dict.get('message_expiry_interval', None)))
+        properties['content_type'] = topic_dict.get('content_type', service_dict.get('content_type', None))
+        user_properties_dict = topic_dict.get('user_properties', service_dict.get('user_properties', {}))
+        properties['user_properties'] = [(name, str(value)) for (name, value) in user_properties_dict.items()]
+
+        return properties
+
+    @staticmethod
+    def configure_compression(topic_dict, service_dict):
+        """ Configure the payload compression. """
+        name = topic_dict.get('compression', service_dict.get('compression', 'none'))
+        if name == 'none':
+            return None
+
+        dictionary = None
+        dictionary_file = topic_dict.get('compression_dictionary', service_dict.get('compression_dictionary', None))
+        if dictionary_file is not None:
+            with open(dictionary_file, 'rb') as file_object:
+                dictionary = file_object.read()
+
+        return PayloadCompressor(name,
+                                 threshold=to_int(topic_dict.get('compression_threshold',
+                                                                 service_dict.get('compression_threshold', 1024))),
+                                 level=to_int(topic_dict.get('compression_level',
+                                                             service_dict.get('compression_level', None))),
+                                 dictionary=dictionary,
+                                 signal=topic_dict.get('compression_signal',
+                                                       service_dict.get('compression_signal', 'content_type')))
+
+    @staticmethod
+    def configure_template(topic_dict, service_dict):
+        """ Configure the payload template. """
+        template_file = topic_dict.get('template_file', service_dict.get('template_file', None))
+        if template_file is not None:
+            with open(template_file, encoding='UTF-8') as file_object:
+                template = file_object.read()
+        else:
+            template = topic_dict.get('template', service_dict.get('template', None))
+            # An unquoted template with commas is read as a list
+            if isinstance(template, list):
+                template = ', '.join(template)
+
+        if template is None:
+            raise ValueError("'template' or 'template_file' is required when the type is template.")
+
+        return CompiledTemplate(template)
+
+    def configure_derived(self, derived):
+        """ Add a topic's derived fields to the derived fields of all topics. """
+        for name in derived.sections:
+            definition = {
+                'expression': derived[name].get('expression', None),
+                'xtype': derived[name].get('xtype', None),
+                'inputs': DerivedFields.get_inputs(name, derived[name]),
+            }
+            if derived[name].get('unit_group') is not None:
+                definition['unit_group'] = derived[name]['unit_group']
+            if name in self.derived_fields and self.derived_fields[name] != definition:
+                raise ValueError(f"Derived field '{name}' is defined differently by more than one topic.")
+            self.derived_fields[name] = definition
+
     def configure_topics(self, service_dict):
         """ Configure the topics. """
-        topic_dict = service_dict.get('topics', None)
-        if topic_dict is None:
+        topics_dict = service_dict.get('topics', None)
+        if topics_dict is None:
             raise ValueError("[[topics]] is required.")
 
         default_qos = to_int(service_dict.get('qos', 0))
@@ -604,8 +1897,8 @@ class MQTTPublish(StdService):
 
         topics_loop = {}
         topics_archive = {}
-        for topic in topic_dict.sections:
-            topic_dict = topic_dict.get(topic, {})
+        for topic in topics_dict.sections:
+            topic_dict = topics_dict.get(topic, {})
             publish = to_bool(topic_dict.get('publish', True))
             qos = to_int(topic_dict.get('qos', default_qos))
             retain = to_bool(topic_dict.get('retain', default_retain))
@@ -643,6 +1936,29 @@ class MQTTPublish(StdService):
 
             # logdbg("Configured aggregates: %s" % aggregates)
 
+            derived = topic_dict.get('derived', {})
+            if derived:
+                self.configure_derived(derived)
+                fields.update(self.configure_fields(derived,
+                                                    ignore,
+                                                    publish_none_value,
+                                                    append_unit_label,
+                                                    conversion_type,
+                                                    format_string))
+
+            properties = self.configure_properties(topic_dict, service_dict)
+            compressor = self.configure_compression(topic_dict, service_dict)
+            template = self.configure_template(topic_dict, service_dict) if data_type == 'template' else None
+            sink = topic_dict.get('sink', service_dict.get('sink', 'mqtt'))
+            bundle = to_bool(topic_dict.get('bundle', False))
+            history = self.configure_history(topic, topic_dict)
+            if history is not None and 'loop' in binding and 'archive' in binding:
+                raise ValueError(f"Topic {topic} has a history, so it can be bound to loop or archive, not both.")
+            if bundle and service_dict.get('bundle', {}).get('topic') is None:
+                raise ValueError(f"A [[bundle]] topic is required to bundle topic {topic}.")
+            if sink != 'mqtt' and sink not in service_dict.get('sinks', {}):
+                raise ValueError(f"Invalid 'sink', {sink}")
+
             if 'loop' in binding:
                 if not publish:
                     continue
@@ -654,12 +1970,24 @@ class MQTTPublish(StdService):
                 topics_loop[topic]['guarantee_delivery'] = to_bool(topic_dict.get('guarantee_delivery', False))
                 if topics_loop[topic]['guarantee_delivery'] and topics_loop[topic]['qos'] == 0:
                     raise ValueError("QOS must be greater than 0 to guarantee delivery.")
+                topics_loop[topic]['priority'] = \
+                    topic_dict.get('priority', 'guaranteed' if topics_loop[topic]['guarantee_delivery'] else 'loop')
+                if topics_loop[topic]['priority'] not in PublishQueue.LANES:
+                    raise ValueError(f"Invalid 'priority', {topics_loop[topic]['priority']}")
                 topics_loop[topic]['ignore'] = ignore
                 topics_loop[topic]['append_unit_label'] = append_unit_label
                 topics_loop[topic]['conversion_type'] = conversion_type
                 topics_loop[topic]['format'] = format_string
                 topics_loop[topic]['fields'] = dict(fields)
                 topics_loop[topic]['aggregates'] = dict(aggregates)
+                topics_loop[topic]['derived'] = list(derived)
+                topics_loop[topic]['properties'] = properties
+                topics_loop[topic]['compressor'] = compressor
+                topics_loop[topic]['template'] = template
+                topics_loop[topic]['home_assistant'] = to_bool(topic_dict.get('home_assistant', True))
+                topics_loop[topic]['sink'] = sink
+                topics_loop[topic]['bundle'] = bundle
+                topics_loop[topic]['history'] = history
 
             if 'archive' in binding:
                 if not publish:
@@ -672,15 +2000,60 @@ class MQTTPublish(StdService):
                 topics_archive[topic]['guarantee_delivery'] = to_bool(topic_dict.get('guarantee_delivery', False))
                 if topics_archive[topic]['guarantee_delivery'] and topics_archive[topic]['qos'] == 0:
                     raise ValueError("QOS must be greater than 0 to guarantee delivery.")
+                topics_archive[topic]['priority'] = topic_dict.get('priority', 'archive')
+                if topics_archive[topic]['priority'] not in PublishQueue.LANES:
+                    raise ValueError(f"Invalid 'priority', {topics_archive[topic]['priority']}")
                 topics_archive[topic]['ignore'] = ignore
                 topics_archive[topic]['append_unit_label'] = append_unit_label
                 topics_archive[topic]['conversion_type'] = conversion_type
                 topics_archive[topic]['format'] = format_string
                 topics_archive[topic]['fields'] = dict(fields)
                 topics_archive[topic]['aggregates'] = dict(aggregates)
+                topics_archive[topic]['derived'] = list(derived)
+                topics_archive[topic]['properties'] = properties
+                topics_archive[topic]['compressor'] = compressor
+                topics_archive[topic]['template'] = template
+                topics_archive[topic]['home_assistant'] = to_bool(topic_dict.get('home_assistant', True))
+                topics_archive[topic]['sink'] = sink
+                topics_archive[topic]['bundle'] = bundle
+                topics_archive[topic]['history'] = history
+
+            if 'schedule' in binding:
+                if not publish:
+                    continue
+                if topic_dict.get('schedule') is None:
+                    raise ValueError(f"A 'schedule' is required for topic {topic}.")
+                schedule_source = topic_dict.get('schedule_source', 'none')
+                if schedule_source not in ['loop', 'archive', 'none']:
+                    raise ValueError(f"Invalid 'schedule_source', {schedule_source}")
+                self.topics_schedule[topic] = {
+                    'qos': qos,
+                    'retain': retain,
+                    'type': data_type,
+                    'unit_system': unit_system,
+                    'schedule': get_schedule(topic_dict['schedule']),
+                    'schedule_source': schedule_source,
+                    'ignore': ignore,
+                    'append_unit_label': append_unit_label,
+                    'conversion_type': conversion_type,
+                    'format': format_string,
+                    'fields': dict(fields),
+                    'aggregates': dict(aggregates),
+                    'derived': list(derived),
+                    'properties': properties,
+                    'compressor': compressor,
+                    'template': template,
+                    'home_assistant': to_bool(topic_dict.get('home_assistant', True)),
+                    'sink': sink,
+                    'bundle': False,
+                    'history': history,
+                }
 
-        logdbg(f"Loop topics: {topics_loop}")
-        logdbg(f"Archive topics: {topics_archive}")
+        # The topics are large, only format them when they are logged
+        if log.isEnabledFor(logging.DEBUG):
+            logdbg(f"Loop topics: {topics_loop}")
+            logdbg(f"Archive topics: {topics_archive}")
+            logdbg(f"Schedule topics: {self.topics_schedule}")
         return topics_loop, topics_archive
 
     def thread_start(self):
@@ -707,32 +2080,108 @@ class MQTTPublish(StdService):
         """ Handle archive records. """
         self._handle_record('archive', event.record)
 
+    def load_spool(self):
+        """ Queue the data that was not published at the last shutdown. """
+        spool = self.mqtt_config['spool']
+        if spool is None or not os.path.exists(spool):
+            return
+
+        count = 0
+        with open(spool, encoding='UTF-8') as file_object:
+            for line in file_object:
+                self.data_queue.put(json.loads(line))
+                count += 1
+        os.remove(spool)
+        loginf(f"Queued {count} records from {spool}")
+
     def _handle_record(self, data_type, data):
+        if not self.accepting:
+            return
+
         if not self._thread.is_alive():
-            if self.thread_restarts < self.max_thread_restarts:
-                self.thread_restarts += 1
-                self._thread = \
-                    PublishWeeWXThread(self.mqtt_config, self.topics_loop, self.topics_archive, self.data_queue)
-                self.thread_start()
-
-                self.data_queue.put({'time_stamp': data['dateTime'], 'type': data_type, 'data': data})
-                self._thread.threading_event.set()
+            if self.restart():
+                self.queue_record(data_type, data)
             elif 'threadEnded' in self.kill_weewx:
                 raise weewx.StopNow("MQTT publishing thread has stopped.")
         else:
-            self.data_queue.put({'time_stamp': data['dateTime'], 'type': data_type, 'data': data})
-            self._thread.threading_event.set()
+            self.check_watchdog()
+            self.queue_record(data_type, data)
+
+    def restart(self):
+        """ Replace the publishing thread or process, if it has restarts left. """
+        if self.restarts >= self.max_restarts:
+            return False
+
+        self.restarts += 1
+        logerr(f"Restarting {self._thread.name}, restart {self.restarts} of {self.max_restarts}.")
+        self._thread = self.get_worker()
+        self.thread_start()
+        return True
+
+    def check_watchdog(self):
+        """ Check the heartbeat and lag of the publishing thread, and act if they are over their limits. """
+        if self.watchdog['stall_timeout'] is None and self.watchdog['max_lag'] is None:
+            return
+
+        status = self._thread.get_status()
+        heartbeat_age = time.time() - status['heartbeat']
+        stalled = self.watchdog['stall_timeout'] is not None and heartbeat_age > self.watchdog['stall_timeout']
+        lagging = self.watchdog['max_lag'] is not None and status['lag'] > self.watchdog['max_lag']
+
+        actions = set()
+        if stalled:
+            logerr(f"{self._thread.name} has not had a heartbeat for {heartbeat_age:.0f} seconds.")
+            actions.add(self.watchdog['stall_action'])
+        if lagging:
+            logerr(f"{self._thread.name} is {status['lag']:.0f} seconds behind, {status['queue_depth']} items queued.")
+            actions.add(self.watchdog['lag_action'])
+
+        if 'kill_weewx' in actions:
+            raise weewx.StopNow("MQTT publishing thread has stalled or fallen behind.")
+
+        if 'shed' in actions and not self.shedding:
+            logerr("Not publishing loop packets until the publishing thread catches up.")
+        elif 'shed' not in actions and self.shedding:
+            loginf("Publishing loop packets again.")
+        self.shedding = 'shed' in actions
+
+        if 'restart' in actions:
+            stalled_worker = self._thread
+            if self.mode == 'process':
+                # The process may be terminated while holding the queue's reader lock,
+                # so the replacement gets a new queue. Whatever is on the old queue is lost.
+                stalled_worker.terminate()
+                self.data_queue.cancel_join_thread()
+                self.data_queue = process_context.Queue()
+            else:
+                # A stalled thread cannot be stopped, tell it to exit when it is no longer stuck and replace it.
+                # The stalled thread keeps its MQTT connection until then, so the replacement needs its own clientid.
+                stalled_worker.running = False
+                self.mqtt_config['clientid'] = f"{self.clientid}-restart{self.restarts + 1}"
+            self.restart()
+
+    def queue_record(self, data_type, data):
+        """ Queue the record once for each priority lane of the data type's topics. """
+        for lane in self.lanes[data_type]:
+            # Only the loop lane is shed, guaranteed topics are always published
+            if lane == 'loop' and self.shedding:
+                continue
+            self.data_queue.put({'time_stamp': data['dateTime'], 'type': data_type, 'lane': lane, 'data': data})
+        self._thread.wakeup()
 
     def shutDown(self):
         """Run when an engine shutdown is requested."""
         loginf("SHUTDOWN - initiated")
+        self.accepting = False
         if self._thread:
             loginf("SHUTDOWN - thread initiated")
-            self._thread.running = False
-            self._thread.threading_event.set()
-            self._thread.join(20.0)
+            self._thread.shutdown()
+            # Allow time for the disconnect after the drain deadline
+            self._thread.join(self.mqtt_config['shutdown_timeout'] + 5.0)
             if self._thread.is_alive():
                 logerr(f"Unable to shut down {self._thread.name} thread")
+                if self.mode == 'process':
+                    self._thread.terminate()
 
             self._thread = None
 
@@ -757,22 +2206,68 @@ class PublishWeeWXThread(threading.Thread):
         'unix_epoch': None,
     }
 
+    unit_cache = UnitCache(UNIT_REDUCTIONS)
+
     def __init__(self, mqtt_config, topics_loop, topics_archive, data_queue):
         threading.Thread.__init__(self)
 
         logdbg(f" native id in init {threading.get_native_id()}")
 
         self.publisher = None
+        # The sinks, other than MQTT, by name
+        self.sinks = {}
+        # The (topic, payload) of the record being published, when bundling
+        self.bundle_messages = None
+        # The RollingHistory of each topic with a history
+        self.histories = {}
         self.running = False
 
         self.db_manager = None
+        self.sliding_windows = {}
+
+        self.derived_fields = None
+        if mqtt_config.get('derived'):
+            self.derived_fields = DerivedFields(mqtt_config['derived'])
+
+        self.load_controller = None
+        # The last published loop values of each topic, for publishing only the changes
+        self.last_published = {}
+        load_shedding_dict = mqtt_config.get('load_shedding') or {}
+        if to_bool(load_shedding_dict.get('enable', False)):
+            self.load_controller = LoadController(load_shedding_dict)
+
+        self.profiler = None
+        profile_dict = mqtt_config.get('profile') or {}
+        if to_bool(profile_dict.get('enable', False)):
+            self.profiler = PublishProfiler(profile_dict)
+
+        # For the watchdog
+        self.heartbeat = time.time()
+        self.lag = 0.0
+        self.last_monitor_time = 0.0
+
+        self.discovery = None
+        home_assistant_dict = mqtt_config.get('home_assistant') or {}
+        if to_bool(home_assistant_dict.get('enable', False)):
+            self.discovery = HomeAssistantDiscovery(home_assistant_dict, mqtt_config.get('lwt'))
 
         self.mqtt_config = mqtt_config
         self.topics_loop = topics_loop
         self.topics_archive = topics_archive
 
+        self.topics_schedule = mqtt_config.get('topics_schedule') or {}
+        self.scheduler = TimerWheel() if self.topics_schedule else None
+        # The last loop packet and archive record, for the schedule topics
+        self.last_records = {}
+
         self.data_queue = data_queue
+        self.topic_lanes = {
+            'loop': self.get_topic_lanes(topics_loop),
+            'archive': self.get_topic_lanes(topics_archive),
+        }
         self.threading_event = threading.Event()
+        self.shutdown_event = threading.Event()
+        self.shutdown_deadline = None
 
     def update_record(self, topic_dict, record):
         """ Update the record. """
@@ -796,24 +2291,61 @@ class PublishWeeWXThread(threading.Thread):
                                               updated_record['usUnits'])
             final_record[name] = value
 
+        final_record.update(self.update_aggregates(topic_dict, record))
+
+        return final_record
+
+    def update_records(self, topic_dict, records):
+        """ Update a batch of records, converting and formatting one field at a time.
+        The aggregates are not included, they are calculated as each record is published.
+        """
+        final_records = [{} for _ in records]
+        unit_system = topic_dict['unit_system']
+
+        fields = list(dict.fromkeys(field for record in records for field in record))
+        for field in fields:
+            fieldinfo = topic_dict['fields'].get(field, {})
+            ignore = fieldinfo.get('ignore', topic_dict.get('ignore'))
+            publish_none_value = fieldinfo.get('publish_none_value', topic_dict.get('publish_none_value'))
+
+            if ignore:
+                continue
+
+            indices = [i for (i, record) in enumerate(records) if field in record]
+            values = self.to_std_system_values(field, [records[i] for i in indices], unit_system)
+            if not publish_none_value:
+                (indices, values) = ([i for (i, value) in zip(indices, values) if value is not None],
+                                     [value for value in values if value is not None])
+
+            (name, formatted_values) = self.update_field_values(topic_dict, fieldinfo, field, values, unit_system)
+            for i, formatted_value in zip(indices, formatted_values):
+                final_records[i][name] = formatted_value
+
+        return final_records
+
+    def update_aggregates(self, topic_dict, record):
+        """ Calculate and format the aggregates. """
+        final_record = {}
         for aggregate_observation in topic_dict['aggregates']:
             # logdbg(topic_dict['aggregates'][aggregate_observation])
 
             time_span = period_timespan[topic_dict['aggregates'][aggregate_observation]['period']](record['dateTime'])
 
             try:
-                aggregate_value_tuple = \
-                    weewx.xtypes.get_aggregate(topic_dict['aggregates'][aggregate_observation]['observation'],
-                                               time_span, topic_dict['aggregates'][aggregate_observation]['aggregation'],
-                                               self.db_manager)
-                aggregate_value = weewx.units.convertStd(aggregate_value_tuple, record['usUnits'])[0]
-                # ToDo: only do once?
-                weewx.units.obs_group_dict[aggregate_observation] = aggregate_value_tuple[2]
+                aggregate_value_tuple = self.get_sliding_aggregate(topic_dict['aggregates'][aggregate_observation],
+                                                                   time_span)
+                if aggregate_value_tuple is None:
+                    aggregate_value_tuple = \
+                        weewx.xtypes.get_aggregate(topic_dict['aggregates'][aggregate_observation]['observation'],
+                                                   time_span, topic_dict['aggregates'][aggregate_observation]['aggregation'],
+                                                   self.db_manager)
+                aggregate_value = weewx.units.convertStd(aggregate_value_tuple, topic_dict['unit_system'])[0]
+                self.unit_cache.set_unit_group(aggregate_observation, aggregate_value_tuple[2])
 
                 (name, value) = self.update_field(topic_dict, topic_dict['aggregates'][aggregate_observation],
                                                   aggregate_observation,
                                                   aggregate_value,
-                                                  updated_record['usUnits'])
+                                                  topic_dict['unit_system'])
 
                 # ToDo: check if observation already in record
                 final_record[name] = value
@@ -824,22 +2356,98 @@ class PublishWeeWXThread(threading.Thread):
 
         return final_record
 
+    def get_sliding_aggregate(self, aggregate, time_span):
+        """ Get a rolling period aggregate from its sliding window, None if it cannot be. """
+        if aggregate['period'] not in sliding_periods or aggregate['aggregation'] not in SlidingWindow.AGGREGATIONS:
+            return None
+        if self.db_manager is None or aggregate['observation'] not in self.db_manager.sqlkeys:
+            return None
+
+        key = (aggregate['observation'], aggregate['period'])
+        sliding_window = self.sliding_windows.get(key)
+        if sliding_window is None:
+            sliding_window = self.load_sliding_window(aggregate['observation'], aggregate['period'], time_span)
+            self.sliding_windows[key] = sliding_window
+
+        # The window has moved past this time, for example when catching up
+        if sliding_window.last_time_stamp is not None and time_span.stop < sliding_window.last_time_stamp:
+            return None
+
+        sliding_window.evict(time_span.start)
+        value = sliding_window.get(aggregate['aggregation'])
+        if aggregate['aggregation'] == 'count':
+            return weewx.units.ValueTuple(value, 'count', 'group_count')
+        (unit_type, unit_group) = weewx.units.getStandardUnitType(self.db_manager.std_unit_system, aggregate['observation'])
+        return weewx.units.ValueTuple(value, unit_type, unit_group)
+
+    def load_sliding_window(self, observation, period, time_span):
+        """ Load a sliding window from the database. """
+        sliding_window = SlidingWindow(observation, period)
+        sql = f"SELECT dateTime, {observation} FROM {self.db_manager.table_name} " \
+              "WHERE dateTime > ? AND dateTime <= ? ORDER BY dateTime ASC"
+        for row in self.db_manager.genSql(sql, time_span):
+            sliding_window.append(row[0], row[1])
+        # Archive records after the last one loaded are added as they arrive.
+        # Not time_span.stop, a loop packet can be ahead of the record of the archive interval it ends.
+        if sliding_window.last_time_stamp is None:
+            sliding_window.last_time_stamp = time_span.start
+        logdbg(f"Loaded {len(sliding_window)} values of {observation} for {period}")
+        return sliding_window
+
+    def update_sliding_windows(self, record):
+        """ Add an archive record to the sliding windows. """
+        if not self.sliding_windows:
+            return
+        std_record = record
+        if self.db_manager.std_unit_system is not None:
+            std_record = weewx.units.to_std_system(record, self.db_manager.std_unit_system)
+        for sliding_window in self.sliding_windows.values():
+            if record['dateTime'] > sliding_window.last_time_stamp:
+                sliding_window.append(record['dateTime'], std_record.get(sliding_window.observation))
+
     @staticmethod
-    def update_field(topic_dict, fieldinfo, field, value, unit_system):
-        """ Update field. """
+    def to_std_system_values(field, records, unit_system):
+        """ Convert the values of a field in a list of records to a unit system. """
+        if field == 'usUnits':
+            return [unit_system] * len(records)
+
+        values = [None] * len(records)
+        indices_by_unit_system = {}
+        for i, record in enumerate(records):
+            indices_by_unit_system.setdefault(record['usUnits'], []).append(i)
+
+        for from_unit_system, indices in indices_by_unit_system.items():
+            column = [records[i][field] for i in indices]
+            if from_unit_system != unit_system:
+                from_unit = PublishWeeWXThread.unit_cache.get(from_unit_system, field)
+                column = weewx.units.StdUnitConverters[unit_system].convert(
+                    weewx.units.ValueTuple(column, from_unit.unit_type, from_unit.unit_group))[0]
+            for i, value in zip(indices, column):
+                values[i] = value
+
+        return values
+
+    @staticmethod
+    def get_field_name(topic_dict, fieldinfo, field, unit_system):
+        """ Get the name of the field, with the unit label appended if configured. """
         name = fieldinfo.get('name', field)
         append_unit_label = fieldinfo.get('append_unit_label', topic_dict.get('append_unit_label'))
         if append_unit_label:
-            (unit_type, _) = weewx.units.getStandardUnitType(unit_system, name)
-            unit_type = PublishWeeWXThread.UNIT_REDUCTIONS.get(unit_type, unit_type)
-            if unit_type is not None:
-                name = f"{name}_{unit_type}"
+            label = PublishWeeWXThread.unit_cache.get(unit_system, name).label
+            if label is not None:
+                name = f"{name}_{label}"
+
+        return name
+
+    @staticmethod
+    def update_field(topic_dict, fieldinfo, field, value, unit_system):
+        """ Update field. """
+        name = PublishWeeWXThread.get_field_name(topic_dict, fieldinfo, field, unit_system)
 
         unit = fieldinfo.get('unit', None)
-        if unit is not None:
-            (from_unit, from_group) = weewx.units.getStandardUnitType(unit_system, field)
-            from_tuple = (value, from_unit, from_group)
-            converted_value = weewx.units.convert(from_tuple, unit)[0]
+        convert = PublishWeeWXThread.unit_cache.get(unit_system, field, unit).convert if unit is not None else None
+        if convert is not None:
+            converted_value = convert(value)
         else:
             converted_value = value
 
@@ -854,34 +2462,390 @@ class PublishWeeWXThread(threading.Thread):
 
         return name, formatted_value
 
-    def publish_row(self, time_stamp, data, topics):
-        """ Publish the data. """
-        record = data
+    @staticmethod
+    def update_field_values(topic_dict, fieldinfo, field, values, unit_system):
+        """ Update a list of values of a field. """
+        name = PublishWeeWXThread.get_field_name(topic_dict, fieldinfo, field, unit_system)
+
+        unit = fieldinfo.get('unit', None)
+        convert = PublishWeeWXThread.unit_cache.get(unit_system, field, unit).convert if unit is not None else None
+        if convert is not None:
+            converted_values = [convert(value) for value in values]
+        else:
+            converted_values = values
+
+        conversion_type = fieldinfo.get('conversion_type', topic_dict.get('conversion_type'))
+        format_string = fieldinfo.get('format', topic_dict.get('format'))
+        if conversion_type == 'integer':
+            formatted_values = [to_int(value) for value in converted_values]
+        else:
+            formatted_values = [format_string % value for value in converted_values]
+            if conversion_type == 'float':
+                formatted_values = [to_float(value) for value in formatted_values]
+
+        return name, formatted_values
+
+    def publish(self, time_stamp, topic_dict, topic, payload):
+        """ Publish a payload using the topic's configuration. """
+        properties = topic_dict.get('properties')
+        bundled = self.bundle_messages is not None and topic_dict.get('bundle')
+
+        compressor = topic_dict.get('compressor')
+        if compressor is not None:
+            compressed_payload = compressor.compress(payload)
+            if compressed_payload is not None:
+                payload = compressed_payload
+                if compressor.signal == 'content_type' and self.mqtt_config['protocol'] == mqtt.MQTTv5 and not bundled:
+                    properties = dict(properties or {}, content_type=compressor.content_type)
+                else:
+                    topic = f"{topic}/{compressor.name}"
+
+        if bundled:
+            self.bundle_messages.append((topic, payload))
+            return
 
+        sink = topic_dict.get('sink', 'mqtt')
+        publisher = self.publisher if sink == 'mqtt' else self.sinks[sink]
+        publisher.publish_message(time_stamp,
+                                  topic_dict['qos'],
+                                  topic_dict['retain'],
+                                  topic,
+                                  payload,
+                                  properties)
+
+    def publish_record(self, time_stamp, topic, topic_dict, updated_record):
+        """ Publish an updated record in the topic's format. """
+        if topic_dict['type'] == 'json':
+            self.publish(time_stamp, topic_dict, topic, json.dumps(updated_record))
+        if topic_dict['type'] == 'keyword':
+            data_keyword = ', '.join(f"{key}={val}" for (key, val) in updated_record.items())
+            self.publish(time_stamp, topic_dict, topic, data_keyword)
+        if topic_dict['type'] == 'individual':
+            for key, value in updated_record.items():
+                self.publish(time_stamp, topic_dict, topic + '/' + key, value)
+        if topic_dict['type'] == 'template':
+            self.publish(time_stamp, topic_dict, topic, topic_dict['template'].render(updated_record))
+
+    def start_schedule(self, now):
+        """ Schedule the first publishing of each schedule topic. """
+        for topic, topic_dict in self.topics_schedule.items():
+            self.scheduler.add(topic_dict['schedule'].next_time(now), topic)
+
+    def publish_scheduled(self, now):
+        """ Publish the schedule topics that are due, and schedule them again. """
+        if self.scheduler is None:
+            return
+        for topic in self.scheduler.advance(now):
+            topic_dict = self.topics_schedule[topic]
+            record = dict(self.last_records.get(topic_dict['schedule_source'], {}))
+            if not record:
+                record['usUnits'] = topic_dict['unit_system']
+            record['dateTime'] = int(now)
+            self.publish_row(int(now), record, {topic: topic_dict})
+            self.scheduler.add(topic_dict['schedule'].next_time(now), topic)
+
+    def get_wait(self):
+        """ The number of seconds to wait for data, waking in time for the next schedule topic. """
+        wait = self.mqtt_config['keepalive'] / 4
+        if self.scheduler:
+            wait = min(wait, self.scheduler.tick)
+        return wait
+
+    def update_history(self, time_stamp, topic, topic_dict, record):
+        """ Add the record to the topic's history and publish it, retained, every publish_interval records. """
+        history_dict = topic_dict['history']
+        history = self.histories.get(topic)
+        if history is None:
+            history = RollingHistory(history_dict['fields'], history_dict['size'])
+            self.histories[topic] = history
+
+        values = {}
+        for field in history_dict['fields']:
+            value = record.get(field)
+            if value is not None:
+                target_unit = self.unit_cache.get(topic_dict['unit_system'], field).unit_type
+                convert = self.unit_cache.get(record['usUnits'], field, target_unit).convert
+                value = convert(value) if convert is not None else value
+            values[field] = value
+        history.append(time_stamp, values)
+
+        if history.appended % history_dict['publish_interval']:
+            return
+        self.publish(time_stamp,
+                     dict(topic_dict, retain=True, bundle=False),
+                     history_dict['topic'],
+                     json.dumps(history.get(history_dict['points'], history_dict['decimals']), separators=(',', ':')))
+
+    def start_bundle(self):
+        """ Start collecting the bundled payloads of a record. """
+        if self.mqtt_config.get('bundle') is not None:
+            self.bundle_messages = []
+
+    def publish_bundle(self, time_stamp):
+        """ Publish the bundled payloads of a record as one message. """
+        messages = self.bundle_messages
+        self.bundle_messages = None
+        if not messages:
+            return
+        bundle_dict = self.mqtt_config['bundle']
+        self.publisher.publish_message(time_stamp,
+                                       bundle_dict['qos'],
+                                       bundle_dict['retain'],
+                                       bundle_dict['topic'],
+                                       encode_bundle(messages))
+
+    def get_derived(self, record, topics):
+        """ Calculate the derived fields used by the topics. """
+        if self.derived_fields is None:
+            return {}
+        names = {name for topic_dict in topics.values() for name in topic_dict.get('derived', [])}
+        if not names:
+            return {}
+        return self.derived_fields.calculate(record, names, self.db_manager)
+
+    @staticmethod
+    def add_derived(topic_dict, record, derived_values):
+        """ Add the topic's derived fields to the record. """
+        if not topic_dict.get('derived'):
+            return record
+        topic_record = dict(record)
+        for name in topic_dict['derived']:
+            topic_record[name] = derived_values.get(name)
+        return topic_record
+
+    def get_delta(self, topic, updated_record):
+        """ Get the fields that changed since the topic was last published. """
+        last_published = self.last_published.setdefault(topic, {})
+        delta_record = {name: value for (name, value) in updated_record.items()
+                        if name == 'dateTime' or last_published.get(name) != value}
+        last_published.update(updated_record)
+        return delta_record
+
+    def publish_row(self, time_stamp, data, topics, delta=None, archive=False):
+        """ Publish the data.
+        When delta is True, only the fields that changed are published; when it is False, the values are remembered for that.
+        An archive record is added to the sliding windows before its aggregates are calculated.
+        """
+        if archive:
+            self.update_sliding_windows(data)
+        derived_values = self.get_derived(data, topics)
+
+        self.start_bundle()
         for topic in topics:
-            if topics[topic]['type'] == 'json':
-                updated_record = self.update_record(topics[topic], record)
-                self.publisher.publish_message(time_stamp,
-                                               topics[topic]['qos'],
-                                               topics[topic]['retain'],
-                                               topic,
-                                               json.dumps(updated_record))
-            if topics[topic]['type'] == 'keyword':
+            if topics[topic]['type'] in ['json', 'keyword', 'individual', 'template']:
+                record = self.add_derived(topics[topic], data, derived_values)
                 updated_record = self.update_record(topics[topic], record)
-                data_keyword = ', '.join(f"{key}={val}" for (key, val) in updated_record.items())
-                self.publisher.publish_message(time_stamp,
-                                               topics[topic]['qos'],
-                                               topics[topic]['retain'],
-                                               topic,
-                                               data_keyword)
-            if topics[topic]['type'] == 'individual':
-                updated_record = self.update_record(topics[topic], record)
-                for key, value in updated_record.items():
-                    self.publisher.publish_message(time_stamp,
-                                                   topics[topic]['qos'],
-                                                   topics[topic]['retain'],
-                                                   topic + '/' + key,
-                                                   value)
+                if delta is not None:
+                    delta_record = self.get_delta(topic, updated_record)
+                    if delta:
+                        updated_record = delta_record
+                self.update_discovery(time_stamp, topic, topics[topic], record, updated_record)
+                self.publish_record(time_stamp, topic, topics[topic], updated_record)
+                if topics[topic].get('history'):
+                    self.update_history(time_stamp, topic, topics[topic], record)
+        self.publish_bundle(time_stamp)
+
+    def publish_rows(self, time_stamps, records, topics):
+        """ Publish a batch of archive records, in order. """
+        derived_values = [self.get_derived(record, topics) for record in records]
+        topic_records = {}
+        updated_records = {}
+        for topic in topics:
+            if topics[topic]['type'] in ['json', 'keyword', 'individual', 'template']:
+                topic_records[topic] = [self.add_derived(topics[topic], record, record_derived_values)
+                                        for record, record_derived_values in zip(records, derived_values)]
+                updated_records[topic] = self.update_records(topics[topic], topic_records[topic])
+
+        for i, time_stamp in enumerate(time_stamps):
+            # Each record is added to the sliding windows just before its aggregates are calculated
+            self.update_sliding_windows(records[i])
+            self.start_bundle()
+            for topic, topic_updated_records in updated_records.items():
+                topic_updated_records[i].update(self.update_aggregates(topics[topic], topic_records[topic][i]))
+                self.update_discovery(time_stamp, topic, topics[topic], topic_records[topic][i], topic_updated_records[i])
+                self.publish_record(time_stamp, topic, topics[topic], topic_updated_records[i])
+                if topics[topic].get('history'):
+                    self.update_history(time_stamp, topic, topics[topic], topic_records[topic][i])
+            self.publish_bundle(time_stamp)
+
+    def update_discovery(self, time_stamp, topic, topic_dict, record, updated_record):
+        """ Publish the Home Assistant discovery payloads of new or changed fields. """
+        if self.discovery is None or not topic_dict.get('home_assistant') or topic_dict['type'] not in ['json', 'individual'] \
+                or topic_dict.get('sink', 'mqtt') != 'mqtt' or topic_dict.get('bundle'):
+            # Bundled topics are not published to their own topic, so there is no state topic
+            return
+
+        # Only look at the fields when they change
+        fields = frozenset(record)
+        if self.discovery.topic_fields.get(topic) == fields:
+            return
+        self.discovery.topic_fields[topic] = fields
+
+        sensors = []
+        observations = [(field, topic_dict['fields'].get(field, {})) for field in record] + \
+            list(topic_dict['aggregates'].items())
+        for field, fieldinfo in observations:
+            name = self.get_field_name(topic_dict, fieldinfo, field, topic_dict['unit_system'])
+            if name not in updated_record or field in ['dateTime', 'usUnits']:
+                continue
+            cached_unit = self.unit_cache.get(topic_dict['unit_system'], field)
+            # Configured fields and aggregates always have a unit, None when it is not set
+            sensors.append((name, fieldinfo.get('unit') or cached_unit.unit_type, cached_unit.unit_group))
+
+        for discovery_topic, payload in self.discovery.update(topic, topic_dict['type'], sensors):
+            self.publisher.publish_message(time_stamp, self.discovery.qos, True, discovery_topic, payload)
+
+    @staticmethod
+    def get_topic_lanes(topics):
+        """ Split the topics by their priority lane. """
+        topic_lanes = {}
+        for topic, topic_dict in topics.items():
+            topic_lanes.setdefault(topic_dict.get('priority'), {})[topic] = topic_dict
+        return topic_lanes
+
+    def get_topics(self, item):
+        """ Get the topics an item is published to. """
+        data_type = item['type']
+        if data_type not in self.topic_lanes:
+            return None
+        # Items without a lane, for example from an older spool, go to all topics
+        if 'lane' not in item:
+            return self.topics_loop if data_type == 'loop' else self.topics_archive
+        return self.topic_lanes[data_type].get(item['lane'], {})
+
+    def get_items(self):
+        """ Get the next item, or run of archive items, from the queue. """
+        items = [self.data_queue.get_nowait()]
+        # When catching up, archive records arrive back to back; get them so that they can be published as a batch.
+        while items[-1]['type'] == 'archive' and items[-1].get('lane') == items[0].get('lane') \
+                and len(items) < self.mqtt_config.get('archive_batch_size', 1):
+            try:
+                items.append(self.data_queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        return items
+
+    def process_items(self, items):
+        """ Publish the items, batching consecutive archive records of the same lane. """
+        for item in items:
+            # Including the items published as a batch
+            if self.topics_schedule and item['type'] in self.topic_lanes:
+                self.last_records[item['type']] = item['data']
+
+        batch_size = 0
+        while batch_size < len(items) and items[batch_size]['type'] == 'archive' \
+                and items[batch_size].get('lane') == items[0].get('lane'):
+            batch_size += 1
+        if batch_size > 1:
+            self.publish_rows([item['time_stamp'] for item in items[:batch_size]],
+                              [item['data'] for item in items[:batch_size]],
+                              self.get_topics(items[0]))
+            items = items[batch_size:]
+
+        for item in items:
+            topics = self.get_topics(item)
+            if topics is None:
+                logerr(f"Unknown data type, {item['type']}")
+                continue
+
+            delta = None
+            if self.load_controller is not None and item['type'] == 'loop' and item.get('lane') != 'guaranteed':
+                latency = self.publisher.get_ack_latency() if self.publisher is not None else 0.0
+                self.load_controller.update(latency, self.data_queue.qsize())
+                if not self.load_controller.admit():
+                    continue
+                topics = self.load_controller.filter_topics(topics)
+                delta = self.load_controller.level >= 2
+
+            self.publish_row(item['time_stamp'], item['data'], topics, delta, item['type'] == 'archive')
+
+        if items and items[-1]['type'] == 'loop':
+            self.lag = time.time() - items[-1]['time_stamp']
+
+    def process_items_profiled(self, items):
+        """ Publish the items while profiling, until the profiling window is over. """
+        if self.profiler.run(self.process_items, items):
+            self.profiler.report()
+            self.profiler = None
+
+    def get_status(self):
+        """ The heartbeat time, the loop lag and the queue depth. """
+        return {'heartbeat': self.heartbeat, 'lag': self.lag, 'queue_depth': self.data_queue.qsize()}
+
+    def publish_status(self):
+        """ Publish the status to the monitor topic, at most once every monitor interval. """
+        monitor_topic = self.mqtt_config.get('monitor_topic')
+        if monitor_topic is None or self.heartbeat - self.last_monitor_time < self.mqtt_config['monitor_interval']:
+            return
+
+        self.last_monitor_time = self.heartbeat
+        status = self.get_status()
+        self.publisher.publish_message(self.heartbeat, 0, False, monitor_topic, json.dumps({
+            'dateTime': int(self.heartbeat),
+            'lag': round(status['lag'], 3),
+            'queue_depth': status['queue_depth'],
+        }))
+
+    def wakeup(self):
+        """ Wake the thread to publish newly queued data. """
+        self.threading_event.set()
+
+    def shutdown(self):
+        """ Stop the thread, publishing the queued data until the shutdown deadline. """
+        self.shutdown_deadline = time.time() + self.mqtt_config['shutdown_timeout']
+        self.running = False
+        self.shutdown_event.set()
+        self.threading_event.set()
+
+    def drain(self):
+        """ Publish the queued data, wait for acknowledgements, spool what is left and disconnect. """
+        while (self.publisher is None or self.publisher.connected) and time.time() < self.shutdown_deadline:
+            try:
+                self.process_items(self.get_items())
+            except Queue.Empty:
+                break
+
+        if self.publisher is not None:
+            self.publisher.wait_for_acknowledgements(self.shutdown_deadline)
+        self.spool()
+        if self.publisher is not None:
+            self.publisher.disconnect(self.shutdown_deadline)
+
+    def spool(self):
+        """ Save the data that has not been published. """
+        items = []
+        while True:
+            try:
+                items.append(self.data_queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        if not items:
+            return
+
+        spool = self.mqtt_config.get('spool')
+        if spool is None:
+            logerr(f"Discarding {len(items)} records that were not published.")
+            return
+
+        with open(spool, 'a', encoding='UTF-8') as file_object:
+            for item in items:
+                file_object.write(json.dumps(item) + '\n')
+        loginf(f"Saved {len(items)} records to {spool}")
+
+    def uses_mqtt(self):
+        """ True if anything is published to MQTT. """
+        return self.mqtt_config.get('monitor_topic') is not None or \
+            any(topic_dict.get('sink', 'mqtt') == 'mqtt' or topic_dict.get('bundle')
+                for topic_dict in list(self.topics_loop.values()) + list(self.topics_archive.values()) +
+                list(self.topics_schedule.values()))
+
+    def close_sinks(self):
+        """ Close the sinks. """
+        for sink in self.sinks.values():
+            sink.close()
+        self.sinks = {}
 
     def run(self):
         self.running = True
@@ -889,31 +2853,106 @@ class PublishWeeWXThread(threading.Thread):
         logdbg(f" native id in run {threading.get_native_id()}")
 
         # need to instantiate inside thread
-        self.publisher = AbstractPublisher.get_publisher(self, self.mqtt_config)
+        if self.mqtt_config.get('db_config') is not None:
+            self.db_manager = weewx.manager.open_manager_with_config(self.mqtt_config['db_config'],
+                                                                     self.mqtt_config['data_binding'])
+        for name, sink_dict in (self.mqtt_config.get('sinks') or {}).items():
+            self.sinks[name] = AbstractSink.get_sink(name, sink_dict)
+        if self.uses_mqtt():
+            self.publisher = AbstractPublisher.get_publisher(self, self.mqtt_config)
+        if self.scheduler is not None:
+            self.start_schedule(time.time())
 
         while self.running:
+            self.heartbeat = time.time()
+            self.publish_status()
+            self.publish_scheduled(self.heartbeat)
+            if self.publisher is not None:
+                self.publisher.message_log.check(self.heartbeat)
             try:
-                data2 = self.data_queue.get_nowait()
-                time_stamp = data2['time_stamp']
-                data_type = data2['type']
-                data = data2['data']
-                if data_type == 'loop':
-                    self.publish_row(time_stamp, data, self.topics_loop)
-                elif data_type == 'archive':
-                    self.publish_row(time_stamp, data, self.topics_archive)
+                if self.profiler is None:
+                    self.process_items(self.get_items())
                 else:
-                    logerr(f"Unknown data type, {data_type}")
+                    self.process_items_profiled(self.get_items())
             except Queue.Empty:
+                # Nothing is queued, so nothing is behind
+                self.lag = 0.0
                 # todo this causes another connection, seems to cause no harm
                 # does cause a socket error/disconnect message on the server
-                self.publisher.client.loop(timeout=0.1)
+                if self.publisher is not None:
+                    self.publisher.client.loop(timeout=0.1)
                 # ToDo - investigate my 'sleep' implementation
-                self.threading_event.wait(self.mqtt_config['keepalive'] / 4)
+                self.threading_event.wait(self.get_wait())
                 self.threading_event.clear()
 
         loginf("exited loop")
+        if self.shutdown_event.is_set():
+            self.drain()
+        elif self.publisher is not None:
+            # Replaced by the watchdog, do not keep the connection open
+            self.publisher.disconnect(time.time() + 5.0)
+        self.close_sinks()
+        if self.db_manager is not None:
+            self.db_manager.close()
         loginf("thread shutdown")
 
+class PublishWeeWXProcess(process_context.Process if process_context is not None else multiprocessing.Process):
+    """ Publish WeeWX data to MQTT from a separate process.
+
+    The process runs a PublishWeeWXThread and moves the data that WeeWX queues on 'process_queue' to it.
+    The process exits when the thread stops, so that MQTTPublish can restart it.
+    """
+    def __init__(self, mqtt_config, topics_loop, topics_archive, process_queue, logging_config):
+        super().__init__(daemon=True)
+        self.mqtt_config = mqtt_config
+        self.topics_loop = topics_loop
+        self.topics_archive = topics_archive
+        self.process_queue = process_queue
+        self.logging_config = logging_config
+        # The heartbeat time and lag of the thread in the process
+        self.status = process_context.Array('d', [time.time(), 0.0])
+
+    def wakeup(self):
+        """ Nothing to do, the process waits on the queue. """
+
+    def shutdown(self):
+        """ Tell the process to publish the queued data and stop. """
+        self.process_queue.put(None)
+
+    def get_status(self):
+        """ The heartbeat time, the loop lag and the queue depth. """
+        try:
+            queue_depth = self.process_queue.qsize()
+        except NotImplementedError:
+            queue_depth = None
+        return {'heartbeat': self.status[0], 'lag': self.status[1], 'queue_depth': queue_depth}
+
+    def run(self):
+        weeutil.logger.setup('weewxd', self.logging_config)
+        if self.logging_config.get('debug'):
+            weewx.debug = to_int(self.logging_config['debug'])
+        loginf(f"{self.name} started with pid {os.getpid()}")
+
+        data_queue = PublishQueue(self.mqtt_config['priority_weights'])
+        publish_thread = PublishWeeWXThread(self.mqtt_config, self.topics_loop, self.topics_archive, data_queue)
+        publish_thread.start()
+
+        while publish_thread.is_alive():
+            self.status[0] = publish_thread.heartbeat
+            self.status[1] = publish_thread.lag
+            try:
+                item = self.process_queue.get(timeout=1.0)
+            except Queue.Empty:
+                continue
+            if item is None:
+                publish_thread.shutdown()
+                break
+            data_queue.put(item)
+            publish_thread.wakeup()
+
+        publish_thread.join(self.mqtt_config['shutdown_timeout'] + 5.0)
+        loginf(f"{self.name} stopped")
+
 if __name__ == "__main__":
     def main():
         """ Run it. """
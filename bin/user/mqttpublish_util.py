@@ -0,0 +1,570 @@
+"""
+Helpers for the MQTTPublish service that do not depend on MQTT:
+the rolling aggregates, the publishing schedules, the profiler, the bundle codec and the sinks.
+"""
+
+import abc
+import array
+import base64
+import collections
+import cProfile
+import datetime
+import io
+import json
+import logging
+import math
+import os
+import pstats
+import re
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import weeutil.weeutil
+from weeutil.weeutil import to_float, to_int
+
+import weewx
+
+log = logging.getLogger(__name__)
+
+def loginf(msg):
+    """ Log informational level. """
+    log.info(msg)
+
+def logerr(msg):
+    """ Log error level. """
+    log.error(msg)
+
+class SlidingWindow():
+    """ The values of an observation over a rolling period.
+
+    The archive values are kept in array backed ring buffers.
+    A running sum and count, and monotonic deques for the minimum and maximum,
+    are updated as values enter and leave the window. So each aggregate is amortized O(1).
+    """
+    AGGREGATIONS = ['min', 'max', 'sum', 'count', 'avg']
+
+    def __init__(self, observation, period, capacity=288):
+        self.observation = observation
+        self.period = period
+        self.time_stamps = array.array('d', bytes(8 * capacity))
+        self.values = array.array('d', bytes(8 * capacity))
+        self.first = 0
+        self.size = 0
+        self.sum = 0.0
+        self.min_deque = collections.deque()
+        self.max_deque = collections.deque()
+        self.last_time_stamp = None
+
+    def __len__(self):
+        return self.size
+
+    def append(self, time_stamp, value):
+        """ Add a value, values must be added in time order. None values are skipped. """
+        self.last_time_stamp = time_stamp
+        if value is None:
+            return
+
+        capacity = len(self.values)
+        if self.size == capacity:
+            self._grow()
+            capacity = len(self.values)
+
+        index = (self.first + self.size) % capacity
+        self.time_stamps[index] = time_stamp
+        self.values[index] = value
+        self.size += 1
+        self.sum += value
+
+        while self.min_deque and self.min_deque[-1][1] >= value:
+            self.min_deque.pop()
+        self.min_deque.append((time_stamp, value))
+        while self.max_deque and self.max_deque[-1][1] <= value:
+            self.max_deque.pop()
+        self.max_deque.append((time_stamp, value))
+
+    def _grow(self):
+        capacity = len(self.values)
+        # Unroll the ring so that the oldest value is first
+        self.time_stamps = self.time_stamps[self.first:] + self.time_stamps[:self.first] + \
+            array.array('d', bytes(8 * capacity))
+        self.values = self.values[self.first:] + self.values[:self.first] + array.array('d', bytes(8 * capacity))
+        self.first = 0
+
+    def evict(self, start):
+        """ Remove the values with a time stamp at or before 'start'. """
+        capacity = len(self.values)
+        while self.size and self.time_stamps[self.first] <= start:
+            self.sum -= self.values[self.first]
+            self.first = (self.first + 1) % capacity
+            self.size -= 1
+
+        while self.min_deque and self.min_deque[0][0] <= start:
+            self.min_deque.popleft()
+        while self.max_deque and self.max_deque[0][0] <= start:
+            self.max_deque.popleft()
+
+        if not self.size:
+            # Do not let rounding errors accumulate
+            self.sum = 0.0
+
+    def get(self, aggregation):
+        """ Get the aggregate of the values in the window. """
+        if aggregation == 'count':
+            return self.size
+        if not self.size:
+            return None
+        if aggregation == 'min':
+            return self.min_deque[0][1]
+        if aggregation == 'max':
+            return self.max_deque[0][1]
+        if aggregation == 'sum':
+            return self.sum
+        if aggregation == 'avg':
+            return self.sum / self.size
+        raise weewx.UnknownAggregation(aggregation)
+
+class RollingHistory():
+    """ The last values of fields, kept in array backed ring buffers. """
+    def __init__(self, fields, size):
+        self.fields = fields
+        self.size = size
+        self.time_stamps = array.array('d', bytes(8 * size))
+        self.values = {field: array.array('d', bytes(8 * size)) for field in fields}
+        self.next = 0
+        self.count = 0
+        # The number of values ever appended
+        self.appended = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, time_stamp, values):
+        """ Add the values, replacing the oldest when full. Missing values are kept as NaN. """
+        self.time_stamps[self.next] = time_stamp
+        for field in self.fields:
+            value = values.get(field)
+            self.values[field][self.next] = value if value is not None else math.nan
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.appended += 1
+
+    def _ordered(self, ring):
+        start = (self.next - self.count) % self.size
+        if start + self.count <= self.size:
+            return ring[start:start + self.count]
+        return ring[start:] + ring[:self.next]
+
+    def get(self, points=None, decimals=None):
+        """ Get the history, oldest first, averaged down to at most 'points' values. """
+        time_stamps = self._ordered(self.time_stamps)
+        columns = {field: self._ordered(self.values[field]) for field in self.fields}
+
+        if points and self.count > points:
+            bounds = [i * self.count // points for i in range(points + 1)]
+            time_stamps = [time_stamps[end - 1] for end in bounds[1:]]
+            for field, column in columns.items():
+                downsampled = []
+                for start, end in zip(bounds, bounds[1:]):
+                    bucket = [value for value in column[start:end] if not math.isnan(value)]
+                    downsampled.append(sum(bucket) / len(bucket) if bucket else math.nan)
+                columns[field] = downsampled
+
+        history = {'dateTime': [int(time_stamp) for time_stamp in time_stamps]}
+        for field, column in columns.items():
+            history[field] = [None if math.isnan(value) else (round(value, decimals) if decimals is not None else value)
+                              for value in column]
+        return history
+
+class IntervalSchedule():
+    """ Every 'interval' seconds, aligned to the clock. """
+    def __init__(self, interval):
+        if interval <= 0:
+            raise ValueError(f"Invalid 'schedule', {interval}")
+        self.interval = interval
+
+    def next_time(self, after):
+        """ The first scheduled time after 'after'. """
+        return (math.floor(after / self.interval) + 1) * self.interval
+
+class CronSchedule():
+    """ A cron specification: minute, hour, day of month, month and day of week (0 or 7 is Sunday). """
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid 'schedule', {spec}")
+        (self.minutes, self.hours, self.days, self.months, days_of_week) = \
+            [self._parse(field, low, high, spec) for field, (low, high) in zip(fields, self.RANGES)]
+        self.days_of_week = {day % 7 for day in days_of_week}
+        # Like cron, when both are restricted a day matches either
+        self.any_day = fields[2] == '*'
+        self.any_day_of_week = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high, spec):
+        values = set()
+        for part in field.split(','):
+            (part, _, step) = part.partition('/')
+            step = int(step) if step else 1
+            if part == '*':
+                (start, end) = (low, high)
+            elif '-' in part:
+                (start, end) = (int(value) for value in part.split('-', 1))
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Invalid 'schedule', {spec}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, date_time):
+        day = date_time.day in self.days
+        day_of_week = (date_time.weekday() + 1) % 7 in self.days_of_week
+        if self.any_day or self.any_day_of_week:
+            return day and day_of_week
+        return day or day_of_week
+
+    def next_time(self, after):
+        """ The first scheduled time after 'after', in local time. """
+        date_time = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        # Skip whole months, days and hours that do not match, so this is quick for sparse schedules.
+        limit = date_time + datetime.timedelta(days=366 * 5)
+        while date_time < limit:
+            if date_time.month not in self.months:
+                date_time = (date_time.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(date_time):
+                date_time = date_time.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif date_time.hour not in self.hours:
+                date_time = date_time.replace(minute=0) + datetime.timedelta(hours=1)
+            elif date_time.minute not in self.minutes:
+                date_time += datetime.timedelta(minutes=1)
+            else:
+                return date_time.timestamp()
+        raise ValueError("The schedule never runs.")
+
+class TimerWheel():
+    """ Timers kept in a ring of slots, each 'tick' seconds wide.
+
+    Adding a timer and advancing the wheel are O(1) per timer, however many timers there are.
+    Timers further away than one turn of the wheel wait in their slot until their tick comes round.
+    """
+    def __init__(self, tick=1.0, slot_count=64):
+        self.tick = tick
+        self.slots = [[] for _ in range(slot_count)]
+        self.current = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, when, item):
+        """ Add an item that is due at 'when'. """
+        tick = int(when // self.tick)
+        if self.current is not None and tick <= self.current:
+            tick = self.current + 1
+        self.slots[tick % len(self.slots)].append((tick, item))
+        self.count += 1
+
+    def advance(self, now):
+        """ Remove and return the items that are due, in time order. """
+        now_tick = int(now // self.tick)
+        if self.current is None:
+            self.current = now_tick - 1
+        if now_tick <= self.current:
+            return []
+
+        due = []
+        # After a long gap every slot is visited once
+        for tick in range(self.current + 1, min(now_tick, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                due.extend(timer for timer in slot if timer[0] <= now_tick)
+                slot[:] = [timer for timer in slot if timer[0] > now_tick]
+        self.current = now_tick
+        self.count -= len(due)
+
+        due.sort(key=lambda timer: timer[0])
+        return [item for (_, item) in due]
+
+def get_schedule(spec):
+    """ Get the schedule for a number of seconds or a cron specification. """
+    # An unquoted specification with commas is read as a list
+    if isinstance(spec, list):
+        spec = ','.join(spec)
+    try:
+        return IntervalSchedule(float(spec))
+    except ValueError:
+        return CronSchedule(spec)
+
+class PublishProfiler():
+    """ Profile the processing of a bounded number of queue items. """
+    # The functions of interest, logged after the top functions
+    FUNCTIONS = 'update_record|update_records|to_std_system|get_aggregate|dumps|publish_message'
+
+    def __init__(self, profile_dict):
+        self.mode = profile_dict.get('mode', 'cprofile')
+        if self.mode not in ['cprofile', 'sample']:
+            raise ValueError(f"Invalid profile 'mode', {self.mode}")
+        self.packets = to_int(profile_dict.get('packets', 100))
+        self.seconds = to_float(profile_dict.get('seconds', None))
+        self.output = profile_dict.get('output', os.path.join(tempfile.gettempdir(), 'mqttpublish-profile'))
+        self.interval = to_float(profile_dict.get('interval', 0.005))
+        self.top = to_int(profile_dict.get('top', 20))
+
+        self.count = 0
+        self.start_time = None
+        self.profile = cProfile.Profile() if self.mode == 'cprofile' else None
+        self.samples = collections.Counter()
+        self.sampling = threading.Event()
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def run(self, func, *args):
+        """ Run and profile func. Return True when the profiling window is over. """
+        if self.start_time is None:
+            self.start_time = time.time()
+            loginf(f"Profiling {self.packets} items with {self.mode}")
+            if self.mode == 'sample':
+                self.sampler = threading.Thread(target=self._sample, args=(threading.get_ident(),), daemon=True)
+                self.sampler.start()
+
+        if self.profile is not None:
+            self.profile.runcall(func, *args)
+        else:
+            self.sampling.set()
+            try:
+                func(*args)
+            finally:
+                self.sampling.clear()
+
+        self.count += 1
+        return self.count >= self.packets or (self.seconds is not None and time.time() - self.start_time >= self.seconds)
+
+    def _sample(self, thread_ident):
+        while not self.stopped.wait(self.interval):
+            if not self.sampling.is_set():
+                continue
+            frame = sys._current_frames().get(thread_ident)  # pylint: disable=protected-access
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def report(self):
+        """ Write the profile and log the top functions. """
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        elapsed = time.time() - self.start_time
+        loginf(f"Profiled {self.count} items in {elapsed:.3f} seconds")
+
+        if self.profile is not None:
+            self.profile.dump_stats(f"{self.output}.pstats")
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=stream).sort_stats('cumulative')
+            stats.print_stats(self.top)
+            stats.print_stats(self.FUNCTIONS)
+            for line in stream.getvalue().splitlines():
+                if line.strip():
+                    loginf(f"Profile: {line}")
+            loginf(f"Profile written to {self.output}.pstats")
+            return
+
+        with open(f"{self.output}.collapsed", 'w', encoding='UTF-8') as file_object:
+            for stack, count in self.samples.items():
+                file_object.write(f"{stack} {count}\n")
+
+        # The functions that were running when sampled, and those of interest anywhere in the stack
+        leaf_counts = collections.Counter()
+        function_counts = collections.Counter()
+        for stack, count in self.samples.items():
+            functions = stack.split(';')
+            leaf_counts[functions[-1]] += count
+            for function in set(functions):
+                if re.search(self.FUNCTIONS, function):
+                    function_counts[function] += count
+        total = sum(self.samples.values()) or 1
+        for function, count in leaf_counts.most_common(self.top):
+            loginf(f"Profile: {100.0 * count / total:5.1f}% self {function}")
+        for function, count in function_counts.most_common():
+            loginf(f"Profile: {100.0 * count / total:5.1f}% total {function}")
+        loginf(f"Profile written to {self.output}.collapsed")
+
+BUNDLE_MAGIC = b'WXB1'
+
+def encode_bundle(messages):
+    """ Frame a list of (topic, payload) into one payload, with an index of the topics. """
+    topics = []
+    payloads = []
+    for topic, payload in messages:
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif not isinstance(payload, bytes):
+            payload = str(payload).encode('utf-8')
+        topics.append(topic.encode('utf-8'))
+        payloads.append(payload)
+
+    index_size = len(BUNDLE_MAGIC) + 2 + sum(2 + len(topic) + 8 for topic in topics)
+    index = [BUNDLE_MAGIC, struct.pack('>H', len(topics))]
+    offset = index_size
+    for topic, payload in zip(topics, payloads):
+        index.append(struct.pack('>H', len(topic)) + topic + struct.pack('>II', offset, len(payload)))
+        offset += len(payload)
+
+    return b''.join(index + payloads)
+
+def decode_bundle(bundle):
+    """ Get the (topic, payload) list of a bundle. The payloads are bytes. """
+    if bundle[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+        raise ValueError("Not a bundle.")
+    position = len(BUNDLE_MAGIC)
+    (count,) = struct.unpack_from('>H', bundle, position)
+    position += 2
+
+    messages = []
+    for _ in range(count):
+        (topic_length,) = struct.unpack_from('>H', bundle, position)
+        position += 2
+        topic = bundle[position:position + topic_length].decode('utf-8')
+        position += topic_length
+        (offset, length) = struct.unpack_from('>II', bundle, position)
+        position += 8
+        messages.append((topic, bundle[offset:offset + length]))
+
+    return messages
+
+class AbstractSink(abc.ABC):
+    """ A destination, other than MQTT, that messages are published to. """
+    # Sinks do not have a broker to lose the connection to
+    connected = True
+
+    def __init__(self, name, sink_dict):
+        self.name = name
+        self.sink_dict = sink_dict
+
+    @classmethod
+    def get_sink(cls, name, sink_dict):
+        ''' Factory method to get the sink of a type. '''
+        sink_type = sink_dict.get('type')
+        if sink_type == 'socket':
+            return SocketSink(name, sink_dict)
+        if sink_type == 'file':
+            return FileSink(name, sink_dict)
+        if sink_type == 'callback':
+            return CallbackSink(name, sink_dict)
+        raise ValueError(f"Invalid sink 'type', {sink_type}")
+
+    @staticmethod
+    def get_line(time_stamp, qos, retain, topic, data):
+        """ Get a message as a line of JSON. """
+        message = {'dateTime': int(time_stamp), 'topic': topic, 'qos': qos, 'retain': retain, 'payload': data}
+        if isinstance(data, bytes):
+            message['payload'] = base64.b64encode(data).decode('ascii')
+            message['encoding'] = 'base64'
+        return json.dumps(message) + '\n'
+
+    @abc.abstractmethod
+    def publish_message(self, time_stamp, qos, retain, topic, data, properties=None):
+        """ Publish the message. """
+
+    def close(self):
+        """ Release the sink's resources. """
+
+class SocketSink(AbstractSink):
+    """ Write messages to a Unix domain socket. Messages are dropped while there is no listener. """
+    def __init__(self, name, sink_dict):
+        super().__init__(name, sink_dict)
+        self.path = sink_dict.get('path')
+        if self.path is None:
+            raise ValueError(f"'path' is required for sink {name}.")
+        self.retry_interval = to_float(sink_dict.get('retry_interval', 10))
+        self.send_timeout = to_float(sink_dict.get('send_timeout', 1))
+        self.socket = None
+        self.last_attempt = 0.0
+
+    def _open(self):
+        now = time.time()
+        if now - self.last_attempt < self.retry_interval:
+            return
+        self.last_attempt = now
+        try:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # A consumer that stops reading must not block the publishing thread
+            self.socket.settimeout(self.send_timeout)
+            self.socket.connect(self.path)
+            loginf(f"Sink {self.name} connected to {self.path}.")
+        except OSError as exception:
+            logerr(f"Sink {self.name} could not connect to {self.path}, {exception}.")
+            self.close()
+
+    def publish_message(self, time_stamp, qos, retain, topic, data, properties=None):
+        if self.socket is None:
+            self._open()
+            if self.socket is None:
+                return
+        try:
+            self.socket.sendall(self.get_line(time_stamp, qos, retain, topic, data).encode('utf-8'))
+        except socket.timeout:
+            # Part of the message may have been sent, so the connection cannot be used again
+            logerr(f"Sink {self.name} timed out writing to {self.path}, the consumer is not reading.")
+            self.close()
+        except OSError as exception:
+            logerr(f"Sink {self.name} failed to write to {self.path}, {exception}.")
+            self.close()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+class FileSink(AbstractSink):
+    """ Append messages to a file, rotating it when it reaches max_bytes. """
+    def __init__(self, name, sink_dict):
+        super().__init__(name, sink_dict)
+        self.path = sink_dict.get('path')
+        if self.path is None:
+            raise ValueError(f"'path' is required for sink {name}.")
+        self.max_bytes = to_int(sink_dict.get('max_bytes', 1048576))
+        self.backup_count = to_int(sink_dict.get('backup_count', 5))
+        self.file_object = open(self.path, 'a', encoding='UTF-8')  # pylint: disable=consider-using-with
+
+    def rotate(self):
+        """ Move path to path.1, path.1 to path.2, and so on, and start a new file. """
+        self.file_object.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file_object = open(self.path, 'a', encoding='UTF-8')  # pylint: disable=consider-using-with
+
+    def publish_message(self, time_stamp, qos, retain, topic, data, properties=None):
+        line = self.get_line(time_stamp, qos, retain, topic, data)
+        if self.max_bytes and self.file_object.tell() + len(line) > self.max_bytes and self.file_object.tell() > 0:
+            self.rotate()
+        self.file_object.write(line)
+        # Consumers follow the file, so do not keep messages in the buffer
+        self.file_object.flush()
+
+    def close(self):
+        self.file_object.close()
+
+class CallbackSink(AbstractSink):
+    """ Call a function with each message. """
+    def __init__(self, name, sink_dict):
+        super().__init__(name, sink_dict)
+        callback = sink_dict.get('callback')
+        if callback is None:
+            raise ValueError(f"'callback' is required for sink {name}.")
+        self.callback = weeutil.weeutil.get_object(callback) if isinstance(callback, str) else callback
+
+    def publish_message(self, time_stamp, qos, retain, topic, data, properties=None):
+        self.callback(time_stamp, qos, retain, topic, data, properties)
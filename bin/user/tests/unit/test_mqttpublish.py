@@ -3,13 +3,45 @@
 #    See the file LICENSE.txt for your full rights.
 #
 
+import base64
 import configobj
+import datetime
 import logging
+import json
+import queue
+import os
+import random
+import socket
+import tempfile
+import time
+import zlib
 
 import unittest
 import mock
 
+import paho.mqtt.client as mqtt
+
+import weewx
+
 import user.mqttpublish
+import user.mqttpublish_util
+
+def get_mqtt_config(protocol=mqtt.MQTTv5):
+    return {
+        'clientid': 'clientid',
+        'protocol': protocol,
+        'log_mqtt': False,
+        'username': None,
+        'password': None,
+        'max_retries': 5,
+    }
+
+def get_publisher(mqtt_config):
+    with mock.patch.object(user.mqttpublish.AbstractPublisher, '_connect'):
+        publisher = user.mqttpublish.AbstractPublisher.get_publisher(mock.Mock(), mqtt_config)
+    publisher.connected = True
+    publisher.client = mock.Mock()
+    return publisher
 
 class TestDeprecatedOptions(unittest.TestCase):
     def test_PublishWeeWX_stanza_is_deprecated(self):
@@ -34,6 +66,805 @@ class TestDeprecatedOptions(unittest.TestCase):
 
         print("end")
 
+class TestMQTTv5Properties(unittest.TestCase):
+    def test_properties_are_set(self):
+        publisher = get_publisher(get_mqtt_config())
+        properties = {
+            'topic_alias': False,
+            'message_expiry_interval': 300,
+            'content_type': 'application/json',
+            'user_properties': [('station', 'home')],
+        }
+
+        publisher.publish_message(0, 0, False, 'weather/loop', '{}', properties)
+
+        call_kwargs = publisher.client.publish.call_args.kwargs
+        self.assertEqual(call_kwargs['properties'].MessageExpiryInterval, 300)
+        self.assertEqual(call_kwargs['properties'].ContentType, 'application/json')
+        self.assertEqual(call_kwargs['properties'].UserProperty, [('station', 'home')])
+
+    def test_topic_alias_replaces_topic(self):
+        publisher = get_publisher(get_mqtt_config())
+        publisher.topic_alias_maximum = 10
+        properties = {'topic_alias': True}
+        topic = 'weather/loop/outTemp_F'
+
+        publisher.publish_message(0, 0, False, topic, random.random(), properties)
+        first_call = publisher.client.publish.call_args
+        publisher.publish_message(0, 0, False, topic, random.random(), properties)
+        second_call = publisher.client.publish.call_args
+
+        self.assertEqual(first_call.args[0], topic)
+        self.assertEqual(first_call.kwargs['properties'].TopicAlias, 1)
+        self.assertEqual(second_call.args[0], '')
+        self.assertEqual(second_call.kwargs['properties'].TopicAlias, 1)
+
+    def test_topic_alias_not_used_with_qos(self):
+        publisher = get_publisher(get_mqtt_config())
+        publisher.topic_alias_maximum = 10
+        topic = 'weather/loop/outTemp_F'
+
+        publisher.publish_message(0, 1, False, topic, random.random(), {'topic_alias': True})
+        publisher.publish_message(0, 1, False, topic, random.random(), {'topic_alias': True})
+
+        self.assertEqual(publisher.client.publish.call_args.args[0], topic)
+        self.assertIsNone(publisher.client.publish.call_args.kwargs['properties'])
+
+    def test_properties_ignored_for_mqtt3(self):
+        publisher = get_publisher(get_mqtt_config(mqtt.MQTTv311))
+
+        publisher.publish_message(0, 0, False, 'weather/loop', '{}', {'message_expiry_interval': 300})
+
+        self.assertIsNone(publisher.client.publish.call_args.kwargs['properties'])
+
+class TestPayloadCompressor(unittest.TestCase):
+    def test_payload_below_threshold_is_not_compressed(self):
+        compressor = user.mqttpublish.PayloadCompressor('zlib', threshold=1024)
+
+        self.assertIsNone(compressor.compress('{"outTemp_F": "70.0"}'))
+
+    def test_zlib_with_dictionary(self):
+        dictionary = b'{"outTemp_F": "", "outHumidity": "", "barometer_inHg": ""}'
+        compressor = user.mqttpublish.PayloadCompressor('zlib', threshold=0, dictionary=dictionary)
+        payload = json.dumps({'outTemp_F': random.random(), 'outHumidity': random.random()})
+
+        decompressor = zlib.decompressobj(zdict=dictionary)
+        self.assertEqual(decompressor.decompress(compressor.compress(payload)).decode('utf-8'), payload)
+
+    def test_invalid_compression(self):
+        with self.assertRaises(ValueError):
+            user.mqttpublish.PayloadCompressor('lzma')
+
+def get_topic_dict(unit_system=weewx.METRIC):
+    return {
+        'qos': 0,
+        'retain': False,
+        'type': 'json',
+        'unit_system': unit_system,
+        'ignore': False,
+        'publish_none_value': False,
+        'append_unit_label': True,
+        'conversion_type': 'string',
+        'format': '%s',
+        'fields': {'windSpeed': {'unit': 'meter_per_second'}},
+        'aggregates': {},
+    }
+
+class TestBatchFormatting(unittest.TestCase):
+    def test_batch_matches_single_record(self):
+        thread = user.mqttpublish.PublishWeeWXThread(get_mqtt_config(), {}, {}, queue.Queue())
+        topic_dict = get_topic_dict()
+        records = []
+        for i in range(5):
+            records.append({
+                'dateTime': 1700000000 + i * 300,
+                'usUnits': weewx.US if i % 2 else weewx.METRICWX,
+                'outTemp': round(random.uniform(-10, 90), 1),
+                'windSpeed': round(random.uniform(0, 30), 1),
+                'rain': None if i == 3 else 0.1,
+            })
+
+        expected = [thread.update_record(topic_dict, record) for record in records]
+
+        self.assertEqual(thread.update_records(topic_dict, records), expected)
+
+class TestUnitCache(unittest.TestCase):
+    def test_conversion_is_cached(self):
+        unit_cache = user.mqttpublish.UnitCache(user.mqttpublish.PublishWeeWXThread.UNIT_REDUCTIONS)
+        value = random.uniform(-10, 40)
+
+        with mock.patch('weewx.units.getStandardUnitType', wraps=weewx.units.getStandardUnitType) as mock_lookup:
+            first = unit_cache.get(weewx.METRIC, 'outTemp', 'degree_F')
+            second = unit_cache.get(weewx.METRIC, 'outTemp', 'degree_F')
+
+            mock_lookup.assert_called_once()
+        self.assertIs(first, second)
+        self.assertEqual(first.label, 'C')
+        self.assertAlmostEqual(first.convert(value), value * 1.8 + 32)
+        self.assertIsNone(first.convert(None))
+
+    def test_set_unit_group_invalidates(self):
+        unit_cache = user.mqttpublish.UnitCache(user.mqttpublish.PublishWeeWXThread.UNIT_REDUCTIONS)
+        obs_type = f"outTempMax{random.randint(1000, 9999)}"
+
+        self.assertIsNone(unit_cache.get(weewx.US, obs_type).label)
+        unit_cache.set_unit_group(obs_type, 'group_temperature')
+
+        self.assertEqual(unit_cache.get(weewx.US, obs_type).label, 'F')
+        del weewx.units.obs_group_dict[obs_type]
+
+class TestShutdown(unittest.TestCase):
+    def test_unpublished_data_is_spooled(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mqtt_config = get_mqtt_config()
+            mqtt_config['shutdown_timeout'] = 1
+            mqtt_config['spool'] = os.path.join(temp_dir, 'spool')
+            data_queue = queue.Queue()
+            item = {'time_stamp': 1700000000, 'type': 'loop', 'data': {'dateTime': 1700000000, 'outTemp': random.random()}}
+            data_queue.put(item)
+            thread = user.mqttpublish.PublishWeeWXThread(mqtt_config, {}, {}, data_queue)
+            thread.publisher = mock.Mock()
+            thread.publisher.connected = False
+
+            thread.shutdown()
+            thread.drain()
+
+            with open(mqtt_config['spool'], encoding='UTF-8') as file_object:
+                self.assertEqual([json.loads(line) for line in file_object], [item])
+            thread.publisher.wait_for_acknowledgements.assert_called_once_with(thread.shutdown_deadline)
+            thread.publisher.disconnect.assert_called_once_with(thread.shutdown_deadline)
+
+class TestPublishQueue(unittest.TestCase):
+    def test_lanes_are_drained_by_weight(self):
+        publish_queue = user.mqttpublish.PublishQueue([2, 1, 1])
+        for i in range(3):
+            publish_queue.put({'type': 'loop', 'lane': 'loop', 'data': i})
+        for i in range(3):
+            publish_queue.put({'type': 'archive', 'lane': 'archive', 'data': i})
+
+        lanes = [publish_queue.get_nowait()['lane'] for _ in range(6)]
+
+        self.assertEqual(lanes, ['archive', 'archive', 'loop', 'archive', 'loop', 'loop'])
+        with self.assertRaises(queue.Empty):
+            publish_queue.get_nowait()
+
+    def test_item_without_lane(self):
+        publish_queue = user.mqttpublish.PublishQueue()
+        publish_queue.put({'type': 'loop', 'data': {}})
+        publish_queue.put({'type': 'archive', 'data': {}})
+
+        self.assertEqual(publish_queue.get_nowait()['type'], 'archive')
+        self.assertEqual(publish_queue.qsize(), 1)
+
+class TestPublishWeeWXProcess(unittest.TestCase):
+    def test_items_are_moved_to_the_thread(self):
+        mqtt_config = get_mqtt_config()
+        mqtt_config['priority_weights'] = [4, 2, 1]
+        mqtt_config['shutdown_timeout'] = 1
+        process_queue = queue.Queue()
+        item = {'time_stamp': 1700000000, 'type': 'loop', 'lane': 'loop', 'data': {'outTemp': random.random()}}
+        process_queue.put(item)
+        process_queue.put(None)
+
+        publish_process = user.mqttpublish.PublishWeeWXProcess(mqtt_config, {}, {}, process_queue, {})
+        with mock.patch('user.mqttpublish.weeutil.logger.setup'):
+            with mock.patch('user.mqttpublish.PublishWeeWXThread') as mock_thread_class:
+                mock_thread = mock_thread_class.return_value
+                mock_thread.is_alive.return_value = True
+                publish_process.run()
+
+        data_queue = mock_thread_class.call_args.args[3]
+        self.assertEqual(data_queue.get_nowait(), item)
+        mock_thread.wakeup.assert_called_once()
+        mock_thread.shutdown.assert_called_once()
+
+    def test_process_is_forked(self):
+        publish_process = user.mqttpublish.PublishWeeWXProcess(get_mqtt_config(), {}, {}, queue.Queue(), {})
+
+        self.assertEqual(publish_process._start_method, 'fork')  # pylint: disable=protected-access
+
+class TestSlidingWindow(unittest.TestCase):
+    def test_aggregates_match_full_scan(self):
+        sliding_window = user.mqttpublish_util.SlidingWindow('outTemp', 'last24hours', capacity=4)
+        values = []
+        for i in range(50):
+            time_stamp = 1700000000 + i * 300
+            value = None if i % 7 == 3 else round(random.uniform(-10, 40), 1)
+            sliding_window.append(time_stamp, value)
+            values.append((time_stamp, value))
+
+            start = time_stamp - 3000
+            sliding_window.evict(start)
+            window_values = [value for (value_time_stamp, value) in values if value_time_stamp > start and value is not None]
+
+            self.assertEqual(sliding_window.get('count'), len(window_values))
+            self.assertEqual(sliding_window.get('min'), min(window_values))
+            self.assertEqual(sliding_window.get('max'), max(window_values))
+            self.assertAlmostEqual(sliding_window.get('sum'), sum(window_values))
+            self.assertAlmostEqual(sliding_window.get('avg'), sum(window_values) / len(window_values))
+
+    def test_empty_window(self):
+        sliding_window = user.mqttpublish_util.SlidingWindow('rain', 'last7days')
+
+        self.assertIsNone(sliding_window.get('max'))
+        self.assertEqual(sliding_window.get('count'), 0)
+
+    def test_record_written_after_loading_is_added(self):
+        thread = user.mqttpublish.PublishWeeWXThread(get_mqtt_config(), {}, {}, queue.Queue())
+        thread.db_manager = mock.Mock(table_name='archive', std_unit_system=None)
+        thread.db_manager.genSql.return_value = [(1700000000 + i * 300, float(i)) for i in range(11)]
+        # Loaded for a loop packet, before the archive record it is ahead of is in the database
+        loop_time_stamp = 1700000000 + 11 * 300 + 2
+        thread.sliding_windows[('outTemp', 'last24hours')] = \
+            thread.load_sliding_window('outTemp', 'last24hours', user.mqttpublish.TimeSpan(loop_time_stamp - 86400,
+                                                                                           loop_time_stamp))
+
+        thread.update_sliding_windows({'dateTime': 1700000000 + 11 * 300, 'usUnits': weewx.US, 'outTemp': 11.0})
+
+        self.assertEqual(thread.sliding_windows[('outTemp', 'last24hours')].get('count'), 12)
+
+    def test_batch_into_unloaded_window(self):
+        rows = [(1700000000 + i * 300, 10.0 + i) for i in range(5)]
+        thread = user.mqttpublish.PublishWeeWXThread(get_mqtt_config(), {}, {}, queue.Queue())
+        thread.publisher = mock.Mock()
+        thread.mqtt_config['archive_batch_size'] = 10
+        thread.db_manager = mock.Mock(table_name='archive', std_unit_system=weewx.US, sqlkeys=['dateTime', 'outTemp'])
+        # The database already has every record of the batch
+        thread.db_manager.genSql.side_effect = lambda sql, time_span: [row for row in rows
+                                                                       if time_span[0] < row[0] <= time_span[1]]
+        topic_dict = get_topic_dict(weewx.US)
+        topic_dict['priority'] = 'archive'
+        topic_dict['aggregates'] = {'outTempMax': {'name': 'outTempMax', 'unit': None, 'ignore': False,
+                                                   'publish_none_value': False, 'append_unit_label': False,
+                                                   'conversion_type': 'float', 'format_string': '%s',
+                                                   'observation': 'outTemp', 'aggregation': 'max',
+                                                   'period': 'last24hours'}}
+        thread.topics_archive = {'weather/archive': topic_dict}
+        thread.topic_lanes['archive'] = thread.get_topic_lanes(thread.topics_archive)
+
+        with mock.patch('weewx.xtypes.get_aggregate') as mock_get_aggregate:
+            thread.process_items([{'time_stamp': time_stamp, 'type': 'archive', 'lane': 'archive',
+                                   'data': {'dateTime': time_stamp, 'usUnits': weewx.US, 'outTemp': value}}
+                                  for (time_stamp, value) in rows])
+
+        mock_get_aggregate.assert_not_called()
+        thread.db_manager.genSql.assert_called_once()
+        self.assertEqual([json.loads(call.args[4])['outTempMax'] for call in thread.publisher.publish_message.call_args_list],
+                         [10.0, 11.0, 12.0, 13.0, 14.0])
+
+class TestCompiledTemplate(unittest.TestCase):
+    def test_render(self):
+        template = user.mqttpublish.CompiledTemplate(
+            'temp={{ outTemp_F }};hum={{outHumidity|json}};rain={{ rain_in | default(n/a) }}')
+        value = str(round(random.uniform(-10, 90), 1))
+
+        self.assertEqual(template.render({'outTemp_F': value, 'outHumidity': '50'}), f'temp={value};hum="50";rain=n/a')
+        self.assertEqual(template.render({}), 'temp=;hum=;rain=n/a')
+
+    def test_invalid_filter(self):
+        with self.assertRaises(ValueError):
+            user.mqttpublish.CompiledTemplate('{{ outTemp | upper }}')
+
+class TestHomeAssistantDiscovery(unittest.TestCase):
+    def test_discovery_is_only_published_when_changed(self):
+        mqtt_config = get_mqtt_config()
+        mqtt_config['home_assistant'] = {'enable': True, 'node_id': 'station'}
+        thread = user.mqttpublish.PublishWeeWXThread(mqtt_config, {}, {}, queue.Queue())
+        thread.publisher = mock.Mock()
+        topic_dict = get_topic_dict()
+        topic_dict['type'] = 'individual'
+        topic_dict['home_assistant'] = True
+        record = {'dateTime': 1700000000, 'usUnits': weewx.US, 'outTemp': round(random.uniform(-10, 90), 1)}
+
+        for _ in range(2):
+            updated_record = thread.update_record(topic_dict, record)
+            thread.update_discovery(record['dateTime'], 'weather', topic_dict, record, updated_record)
+
+        thread.publisher.publish_message.assert_called_once()
+        (_, qos, retain, discovery_topic, payload) = thread.publisher.publish_message.call_args.args
+        config = json.loads(payload)
+        self.assertEqual((qos, retain), (1, True))
+        self.assertEqual(discovery_topic, 'homeassistant/sensor/station/weather_outTemp_C/config')
+        self.assertEqual(config['state_topic'], 'weather/outTemp_C')
+        self.assertEqual(config['unit_of_measurement'], '°C')
+        self.assertEqual(config['device_class'], 'temperature')
+
+    def test_configured_field_and_aggregate_have_units(self):
+        mqtt_config = get_mqtt_config()
+        mqtt_config['home_assistant'] = {'enable': True, 'node_id': 'station'}
+        thread = user.mqttpublish.PublishWeeWXThread(mqtt_config, {}, {}, queue.Queue())
+        thread.publisher = mock.Mock()
+        field_options = {'unit': None, 'ignore': False, 'publish_none_value': False, 'append_unit_label': True,
+                         'conversion_type': 'string', 'format_string': '%s'}
+        topic_dict = get_topic_dict()
+        topic_dict['home_assistant'] = True
+        topic_dict['fields'] = {'outTemp': dict(field_options, name='outTemp')}
+        topic_dict['aggregates'] = {'outTempMaxDay': dict(field_options, name='outTempMaxDay', observation='outTemp',
+                                                          aggregation='max', period='day')}
+        record = {'dateTime': 1700000000, 'usUnits': weewx.US, 'outTemp': round(random.uniform(-10, 90), 1)}
+
+        with mock.patch('weewx.xtypes.get_aggregate',
+                        return_value=weewx.units.ValueTuple(100.0, 'degree_F', 'group_temperature')):
+            updated_record = thread.update_record(topic_dict, record)
+        thread.update_discovery(record['dateTime'], 'weather', topic_dict, record, updated_record)
+
+        configs = {json.loads(call.args[4])['value_template']: json.loads(call.args[4])
+                   for call in thread.publisher.publish_message.call_args_list}
+        self.assertEqual(len(configs), 2)
+        for config in configs.values():
+            self.assertEqual(config['unit_of_measurement'], '°C')
+            self.assertEqual(config['device_class'], 'temperature')
+
+class TestWatchdog(unittest.TestCase):
+    def get_service(self, watchdog_dict, topics=None):
+        config = configobj.ConfigObj({
+            'MQTTPublish': {
+                'watchdog': watchdog_dict,
+                'topics': dict({
+                    'weather/loop': {'binding': 'loop'},
+                    'weather/archive': {'binding': 'archive'},
+                }, **(topics or {})),
+            },
+        })
+        with mock.patch('user.mqttpublish.PublishWeeWXThread'):
+            service = user.mqttpublish.MQTTPublish(mock.Mock(), config)
+        return service
+
+    def test_loop_packets_are_shed_when_lagging(self):
+        service = self.get_service({'max_lag': 30})
+        service._thread.get_status.return_value = {'heartbeat': time.time(), 'lag': 60.0, 'queue_depth': 100}
+        time_stamp = int(time.time())
+
+        service._handle_record('loop', {'dateTime': time_stamp, 'usUnits': weewx.US})
+        service._handle_record('archive', {'dateTime': time_stamp, 'usUnits': weewx.US})
+
+        self.assertTrue(service.shedding)
+        self.assertEqual(service.data_queue.qsize(), 1)
+        self.assertEqual(service.data_queue.get_nowait()['type'], 'archive')
+
+        service._thread.get_status.return_value = {'heartbeat': time.time(), 'lag': 0.0, 'queue_depth': 0}
+        service._handle_record('loop', {'dateTime': time_stamp, 'usUnits': weewx.US})
+
+        self.assertFalse(service.shedding)
+        self.assertEqual(service.data_queue.get_nowait()['type'], 'loop')
+
+    def test_guaranteed_loop_topics_are_not_shed(self):
+        guaranteed_topic = {'binding': 'loop', 'qos': 1, 'guarantee_delivery': True}
+        service = self.get_service({'max_lag': 30}, {'weather/guaranteed': guaranteed_topic})
+        service._thread.get_status.return_value = {'heartbeat': time.time(), 'lag': 60.0, 'queue_depth': 100}
+
+        service._handle_record('loop', {'dateTime': int(time.time()), 'usUnits': weewx.US})
+
+        self.assertTrue(service.shedding)
+        self.assertEqual(service.data_queue.qsize(), 1)
+        self.assertEqual(service.data_queue.get_nowait()['lane'], 'guaranteed')
+
+    def test_stalled_thread_is_restarted(self):
+        service = self.get_service({'stall_timeout': 60})
+        stalled_thread = service._thread
+        stalled_thread.get_status.return_value = {'heartbeat': time.time() - 120, 'lag': 0.0, 'queue_depth': 0}
+
+        with mock.patch.object(service, 'get_worker') as mock_get_worker:
+            service._handle_record('loop', {'dateTime': int(time.time()), 'usUnits': weewx.US})
+
+        self.assertFalse(stalled_thread.running)
+        self.assertIs(service._thread, mock_get_worker.return_value)
+        self.assertEqual(service.restarts, 1)
+        self.assertEqual(service.mqtt_config['clientid'], f"{service.clientid}-restart1")
+
+    def test_stalled_process_gets_a_new_queue(self):
+        service = self.get_service({'stall_timeout': 60})
+        service.mode = 'process'
+        stalled_process = service._thread
+        stalled_process.get_status.return_value = {'heartbeat': time.time() - 120, 'lag': 0.0, 'queue_depth': 0}
+        old_queue = service.data_queue = mock.Mock()
+
+        with mock.patch.object(service, 'get_worker') as mock_get_worker:
+            with mock.patch.object(user.mqttpublish.process_context, 'Queue') as mock_queue:
+                service.check_watchdog()
+
+        stalled_process.terminate.assert_called_once()
+        old_queue.cancel_join_thread.assert_called_once()
+        self.assertIs(service.data_queue, mock_queue.return_value)
+        self.assertIs(service._thread, mock_get_worker.return_value)
+
+class TestPublishProfiler(unittest.TestCase):
+    def test_cprofile_window(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, 'profile')
+            profiler = user.mqttpublish_util.PublishProfiler({'mode': 'cprofile', 'packets': 2, 'output': output})
+            payload = {'outTemp': random.random()}
+
+            self.assertFalse(profiler.run(json.dumps, payload))
+            self.assertTrue(profiler.run(json.dumps, payload))
+            profiler.report()
+
+            self.assertTrue(os.path.exists(f"{output}.pstats"))
+
+    def test_sample_window(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, 'profile')
+            profiler = user.mqttpublish_util.PublishProfiler({'mode': 'sample', 'packets': 1, 'interval': 0.001, 'output': output})
+
+            self.assertTrue(profiler.run(time.sleep, 0.05))
+            profiler.report()
+
+            with open(f"{output}.collapsed", encoding='UTF-8') as file_object:
+                self.assertIn('test_mqttpublish.py:test_sample_window', file_object.read())
+
+class TestDerivedFields(unittest.TestCase):
+    def get_derived_fields(self):
+        definitions = user.mqttpublish.DerivedFields.sort({
+            'spread': {'expression': 'outTemp - dewpoint', 'xtype': None,
+                       'inputs': user.mqttpublish.DerivedFields.get_inputs('spread', {'expression': 'outTemp - dewpoint'})},
+            'dewpoint': {'expression': None, 'xtype': None,
+                         'inputs': user.mqttpublish.DerivedFields.get_inputs('dewpoint', {})},
+        })
+        self.assertEqual(list(definitions), ['dewpoint', 'spread'])
+        return user.mqttpublish.DerivedFields(definitions)
+
+    def test_calculated_once_while_inputs_unchanged(self):
+        derived_fields = self.get_derived_fields()
+        dewpoint = round(random.uniform(0, 50), 1)
+        record = {'dateTime': 1700000000, 'usUnits': weewx.US, 'outTemp': dewpoint + 10, 'outHumidity': 70.0}
+
+        with mock.patch('weewx.xtypes.get_scalar',
+                        return_value=weewx.units.ValueTuple(dewpoint, 'degree_F', 'group_temperature')) as mock_get_scalar:
+            values = derived_fields.calculate(record, {'spread'})
+            derived_fields.calculate(dict(record, dateTime=1700000002), {'spread'})
+
+        mock_get_scalar.assert_called_once()
+        self.assertEqual(values, {'dewpoint': dewpoint, 'spread': record['outTemp'] - dewpoint})
+
+    def test_expression_fields_are_inputs(self):
+        definition = {'expression': 'outTemp - dewpoint', 'inputs': 'outTemp'}
+
+        self.assertEqual(user.mqttpublish.DerivedFields.get_inputs('spread', definition), ['dewpoint', 'outTemp'])
+
+    def test_missing_name_is_logged(self):
+        derived_fields = user.mqttpublish.DerivedFields({'spread': {'expression': 'outTemp - dewpoint', 'xtype': None,
+                                                                    'inputs': ['outTemp']}})
+        logger = logging.getLogger('user.mqttpublish')
+
+        with mock.patch.object(logger, 'error') as mock_error:
+            values = derived_fields.calculate({'dateTime': 1700000000, 'usUnits': weewx.US, 'outTemp': 70.0}, {'spread'})
+
+        self.assertEqual(values, {'spread': None})
+        mock_error.assert_called_once()
+
+    def test_invalid_expression(self):
+        with self.assertRaises(ValueError):
+            user.mqttpublish.DerivedFields.parse('__import__("os").getcwd()')
+
+    def test_cycle(self):
+        with self.assertRaises(ValueError):
+            user.mqttpublish.DerivedFields.sort({'a': {'inputs': ['b']}, 'b': {'inputs': ['a']}})
+
+class TestLoadController(unittest.TestCase):
+    def test_levels_degrade_and_recover(self):
+        controller = user.mqttpublish.LoadController({'latency_thresholds': ['1', '2', '3'],
+                                                      'queue_thresholds': ['10', '20', '30'],
+                                                      'recovery': '0.5'})
+
+        self.assertEqual(controller.update(0.1, 0), 0)
+        self.assertEqual(controller.update(2.5, 0), 2)
+        self.assertEqual(controller.update(0.1, 35), 3)
+        # Under the level 3 thresholds, but not yet under the recovery point
+        self.assertEqual(controller.update(2.0, 0), 3)
+        self.assertEqual(controller.update(0.6, 0), 1)
+        self.assertEqual(controller.update(0.1, 0), 0)
+
+    def test_level_3_drops_individual_topics(self):
+        controller = user.mqttpublish.LoadController({'rate_divisor': 2})
+        controller.level = 3
+        topics = {'weather/loop': {'type': 'json'}, 'weather': {'type': 'individual'}}
+
+        self.assertEqual(list(controller.filter_topics(topics)), ['weather/loop'])
+        self.assertEqual([controller.admit() for _ in range(4)], [False, True, False, True])
+
+    def test_ack_latency_includes_oldest_inflight(self):
+        publisher = get_publisher(get_mqtt_config())
+        publisher.inflight = {1: time.time() - 10, 2: time.time()}
+
+        publisher.acknowledged(2)
+
+        self.assertGreaterEqual(publisher.get_ack_latency(), 10)
+        self.assertEqual(list(publisher.inflight), [1])
+
+class TestSinks(unittest.TestCase):
+    def test_callback_sink_without_mqtt(self):
+        messages = []
+        topic_dict = get_topic_dict()
+        topic_dict['sink'] = 'local'
+        mqtt_config = get_mqtt_config()
+        mqtt_config['sinks'] = {'local': {'type': 'callback', 'callback': lambda *args: messages.append(args)}}
+        thread = user.mqttpublish.PublishWeeWXThread(mqtt_config, {'weather/loop': topic_dict}, {}, queue.Queue())
+        thread.sinks['local'] = user.mqttpublish_util.AbstractSink.get_sink('local', mqtt_config['sinks']['local'])
+        record = {'dateTime': 1700000000, 'usUnits': weewx.METRIC, 'outTemp': round(random.uniform(-10, 30), 1)}
+
+        thread.publish_row(record['dateTime'], record, thread.topics_loop)
+
+        self.assertFalse(thread.uses_mqtt())
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0][3], 'weather/loop')
+        self.assertEqual(json.loads(messages[0][4]), thread.update_record(topic_dict, record))
+
+    def test_file_sink_rotates(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'messages')
+            sink_dict = {'type': 'file', 'path': path, 'max_bytes': '150', 'backup_count': '1'}
+            sink = user.mqttpublish_util.AbstractSink.get_sink('file', sink_dict)
+            for i in range(4):
+                sink.publish_message(1700000000 + i, 0, False, 'weather', b'\x00' * 40)
+            sink.close()
+
+            with open(path, encoding='UTF-8') as file_object:
+                message = json.loads(file_object.readline())
+            self.assertTrue(os.path.exists(f"{path}.1"))
+            self.assertFalse(os.path.exists(f"{path}.2"))
+            self.assertEqual(message['dateTime'], 1700000003)
+            self.assertEqual(base64.b64decode(message['payload']), b'\x00' * 40)
+
+    def test_socket_sink(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'socket')
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+                server.bind(path)
+                server.listen(1)
+                sink = user.mqttpublish_util.AbstractSink.get_sink('socket', {'type': 'socket', 'path': path})
+                sink.publish_message(1700000000, 1, True, 'weather/outTemp', '21.5')
+                connection, _ = server.accept()
+                with connection:
+                    message = json.loads(connection.makefile().readline())
+                sink.close()
+
+            self.assertEqual(message, {'dateTime': 1700000000, 'topic': 'weather/outTemp', 'qos': 1,
+                                       'retain': True, 'payload': '21.5'})
+
+    def test_socket_sink_does_not_block(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'socket')
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+                server.bind(path)
+                # The connection is never accepted or read
+                server.listen(1)
+                sink_dict = {'type': 'socket', 'path': path, 'send_timeout': '0.1'}
+                sink = user.mqttpublish_util.AbstractSink.get_sink('socket', sink_dict)
+                start = time.time()
+                for _ in range(20):
+                    sink.publish_message(1700000000, 0, False, 'weather', 'x' * 100000)
+                    if sink.socket is None:
+                        break
+
+                self.assertIsNone(sink.socket)
+                self.assertLess(time.time() - start, 5)
+
+class TestBundle(unittest.TestCase):
+    def test_round_trip(self):
+        messages = [('weather/loop', '{"outTemp": 21.5}'), ('weather/rain', 0.25), ('weather/zlib', zlib.compress(b'x' * 100))]
+
+        self.assertEqual(user.mqttpublish_util.decode_bundle(user.mqttpublish_util.encode_bundle(messages)),
+                         [('weather/loop', b'{"outTemp": 21.5}'), ('weather/rain', b'0.25'),
+                          ('weather/zlib', zlib.compress(b'x' * 100))])
+
+    def test_one_message_per_record(self):
+        mqtt_config = get_mqtt_config()
+        mqtt_config['bundle'] = {'topic': 'weather/bundle', 'qos': 1, 'retain': False}
+        topics = {}
+        for topic in ['weather/json', 'weather/individual', 'weather/separate']:
+            topics[topic] = get_topic_dict()
+            topics[topic]['bundle'] = topic != 'weather/separate'
+        topics['weather/individual']['type'] = 'individual'
+        thread = user.mqttpublish.PublishWeeWXThread(mqtt_config, {}, topics, queue.Queue())
+        thread.publisher = mock.Mock()
+        record = {'dateTime': 1700000000, 'usUnits': weewx.METRIC, 'outTemp': round(random.uniform(-10, 30), 1)}
+
+        thread.publish_rows([record['dateTime']], [record], topics)
+
+        self.assertEqual([call.args[3] for call in thread.publisher.publish_message.call_args_list],
+                         ['weather/separate', 'weather/bundle'])
+        bundle = thread.publisher.publish_message.call_args.args[4]
+        self.assertEqual([topic for topic, _ in user.mqttpublish_util.decode_bundle(bundle)],
+                         ['weather/json', 'weather/individual/dateTime', 'weather/individual/usUnits',
+                          'weather/individual/outTemp_C'])
+
+    def test_no_discovery_for_bundled_topics(self):
+        mqtt_config = get_mqtt_config()
+        mqtt_config['home_assistant'] = {'enable': True}
+        mqtt_config['bundle'] = {'topic': 'weather/bundle', 'qos': 0, 'retain': False}
+        topic_dict = get_topic_dict()
+        topic_dict.update({'home_assistant': True, 'bundle': True})
+        thread = user.mqttpublish.PublishWeeWXThread(mqtt_config, {}, {}, queue.Queue())
+        thread.publisher = mock.Mock()
+        record = {'dateTime': 1700000000, 'usUnits': weewx.METRIC, 'outTemp': round(random.uniform(-10, 30), 1)}
+
+        thread.publish_row(record['dateTime'], record, {'weather/json': topic_dict})
+
+        self.assertEqual([call.args[3] for call in thread.publisher.publish_message.call_args_list], ['weather/bundle'])
+
+class TestRollingHistory(unittest.TestCase):
+    def test_ring_and_downsample(self):
+        history = user.mqttpublish_util.RollingHistory(['outTemp'], 4)
+        values = [round(random.uniform(-10, 30), 1) for _ in range(6)]
+        for i, value in enumerate(values):
+            history.append(1700000000 + i, {'outTemp': None if i == 5 else value})
+
+        self.assertEqual(history.get(), {'dateTime': [1700000002, 1700000003, 1700000004, 1700000005],
+                                         'outTemp': [values[2], values[3], values[4], None]})
+        self.assertEqual(history.get(points=2, decimals=2),
+                         {'dateTime': [1700000003, 1700000005],
+                          'outTemp': [round((values[2] + values[3]) / 2, 2), values[4]]})
+
+    def test_published_in_topic_units(self):
+        thread = user.mqttpublish.PublishWeeWXThread(get_mqtt_config(), {}, {}, queue.Queue())
+        thread.publisher = mock.Mock()
+        topic_dict = get_topic_dict()
+        topic_dict['history'] = {'fields': ['outTemp'], 'size': 10, 'points': None, 'decimals': 1,
+                                 'publish_interval': 2, 'topic': 'weather/history'}
+
+        for i in range(2):
+            record = {'dateTime': 1700000000 + i, 'usUnits': weewx.US, 'outTemp': 212.0}
+            thread.update_history(record['dateTime'], 'weather', topic_dict, record)
+
+        thread.publisher.publish_message.assert_called_once()
+        (_, _, retain, topic, payload, _) = thread.publisher.publish_message.call_args.args
+        self.assertTrue(retain)
+        self.assertEqual(topic, 'weather/history')
+        self.assertEqual(json.loads(payload), {'dateTime': [1700000000, 1700000001], 'outTemp': [100.0, 100.0]})
+
+    def test_history_cannot_be_bound_to_loop_and_archive(self):
+        config = configobj.ConfigObj({'MQTTPublish': {'topics': {
+            'weather': {'binding': ['loop', 'archive'], 'history': {'fields': 'outTemp'}}}}})
+
+        with mock.patch('user.mqttpublish.PublishWeeWXThread'):
+            with self.assertRaises(ValueError):
+                user.mqttpublish.MQTTPublish(mock.Mock(), config)
+
+class TestSchedule(unittest.TestCase):
+    def test_interval_is_aligned(self):
+        schedule = user.mqttpublish_util.get_schedule('300')
+
+        self.assertEqual(schedule.next_time(1700000000), 1700000100)
+        self.assertEqual(schedule.next_time(1700000100), 1700000400)
+
+    def test_cron(self):
+        # Unquoted commas are read as a list
+        schedule = user.mqttpublish_util.get_schedule(['0', '30 9-10 * * 1-5'])
+        # A Saturday
+        after = datetime.datetime(2024, 6, 15, 9, 40).timestamp()
+
+        self.assertEqual(datetime.datetime.fromtimestamp(schedule.next_time(after)), datetime.datetime(2024, 6, 17, 9, 0))
+        self.assertEqual(datetime.datetime.fromtimestamp(schedule.next_time(datetime.datetime(2024, 6, 17, 9, 0).timestamp())),
+                         datetime.datetime(2024, 6, 17, 9, 30))
+
+    def test_invalid_cron(self):
+        with self.assertRaises(ValueError):
+            user.mqttpublish_util.get_schedule('61 * * * *')
+
+    def test_timer_wheel(self):
+        wheel = user.mqttpublish_util.TimerWheel(tick=1.0, slot_count=4)
+        wheel.advance(1000)
+        wheel.add(1010, 'later')
+        wheel.add(1002, 'soon')
+        wheel.add(1001, 'first')
+
+        self.assertEqual(wheel.advance(1002.5), ['first', 'soon'])
+        self.assertEqual(wheel.advance(1006), [])
+        self.assertEqual(wheel.advance(1011), ['later'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_publishes_last_values(self):
+        topic_dict = get_topic_dict()
+        topic_dict.update({'schedule': user.mqttpublish_util.get_schedule('60'), 'schedule_source': 'loop'})
+        mqtt_config = get_mqtt_config()
+        mqtt_config['topics_schedule'] = {'weather/minute': topic_dict}
+        thread = user.mqttpublish.PublishWeeWXThread(mqtt_config, {}, {}, queue.Queue())
+        thread.publisher = mock.Mock()
+        packet = {'dateTime': 1700000005, 'usUnits': weewx.METRIC, 'outTemp': round(random.uniform(-10, 30), 1)}
+
+        thread.start_schedule(1700000005)
+        thread.process_items([{'time_stamp': packet['dateTime'], 'type': 'loop', 'lane': 'loop', 'data': packet}])
+        thread.publish_scheduled(1700000030)
+        thread.publisher.publish_message.assert_not_called()
+        thread.publish_scheduled(1700000040)
+
+        (time_stamp, _, _, topic, payload, _) = thread.publisher.publish_message.call_args.args
+        self.assertEqual((time_stamp, topic), (1700000040, 'weather/minute'))
+        self.assertEqual(json.loads(payload), thread.update_record(topic_dict, dict(packet, dateTime=1700000040)))
+
+    def test_last_archive_record_of_a_batch(self):
+        topic_dict = get_topic_dict()
+        topic_dict.update({'schedule': user.mqttpublish_util.get_schedule('60'), 'schedule_source': 'archive'})
+        mqtt_config = get_mqtt_config()
+        mqtt_config['topics_schedule'] = {'weather/minute': topic_dict}
+        thread = user.mqttpublish.PublishWeeWXThread(mqtt_config, {}, {}, queue.Queue())
+        thread.publisher = mock.Mock()
+        records = [{'dateTime': 1700000000 + i * 300, 'usUnits': weewx.METRIC, 'outTemp': round(random.uniform(-10, 30), 1)}
+                   for i in range(3)]
+
+        thread.process_items([{'time_stamp': record['dateTime'], 'type': 'archive', 'lane': 'archive', 'data': record}
+                              for record in records])
+
+        self.assertIs(thread.last_records['archive'], records[-1])
+
+class TestPersistentSession(unittest.TestCase):
+    def test_clientid_is_saved(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config = configobj.ConfigObj({'WEEWX_ROOT': temp_dir,
+                                          'MQTTPublish': {'persistent_session': True, 'topics': {'weather': {}}}})
+            clientids = []
+            for _ in range(2):
+                with mock.patch('user.mqttpublish.PublishWeeWXThread'):
+                    clientids.append(user.mqttpublish.MQTTPublish(mock.Mock(), config).mqtt_config['clientid'])
+
+            self.assertEqual(clientids[0], clientids[1])
+            self.assertRegex(clientids[0], r'^MQTTPublish-[0-9a-f]{32}$')
+            with open(os.path.join(temp_dir, 'mqttpublish.clientid'), encoding='UTF-8') as file_object:
+                self.assertEqual(file_object.read().strip(), clientids[0])
+
+    def test_mqttv5_session_is_not_clean(self):
+        mqtt_config = get_mqtt_config()
+        mqtt_config.update({'persistent_session': True, 'session_expiry_interval': 600})
+        publisher = get_publisher(mqtt_config)
+
+        publisher.connect('localhost', 1883, 60)
+
+        call_kwargs = publisher.client.connect.call_args.kwargs
+        self.assertFalse(call_kwargs['clean_start'])
+        self.assertEqual(call_kwargs['properties'].SessionExpiryInterval, 600)
+
+    def test_mqtt3_session_is_not_clean(self):
+        mqtt_config = get_mqtt_config(mqtt.MQTTv311)
+        mqtt_config['persistent_session'] = True
+        with mock.patch.object(user.mqttpublish.AbstractPublisher, '_connect'):
+            with mock.patch('user.mqttpublish.mqtt.Client') as mock_client:
+                user.mqttpublish.AbstractPublisher.get_publisher(mock.Mock(), mqtt_config)
+
+        self.assertFalse(mock_client.call_args.kwargs['clean_session'])
+
+class TestMessageLog(unittest.TestCase):
+    def test_nothing_is_formatted_when_off(self):
+        publisher = get_publisher(get_mqtt_config())
+        publisher.message_log.enabled = False
+
+        with mock.patch.object(publisher.message_log, 'published') as mock_published:
+            publisher.publish_message(1700000000, 0, False, 'weather/loop', '{}')
+            mock_published.assert_not_called()
+
+    def test_debug_is_sampled(self):
+        logger = logging.getLogger('user.mqttpublish')
+        with mock.patch.object(logger, 'isEnabledFor', return_value=True):
+            message_log = user.mqttpublish.MessageLog({'sample': '3'})
+        with mock.patch.object(logger, 'debug') as mock_debug:
+            for mid in range(6):
+                message_log.published(1700000000, mid, 0, False, 'weather/loop', '{}')
+
+        self.assertEqual(mock_debug.call_count, 2)
+
+    def test_trace_file_switches_tracing(self):
+        logger = logging.getLogger('user.mqttpublish')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            trace_file = os.path.join(temp_dir, 'trace')
+            message_log = user.mqttpublish.MessageLog({'trace_file': trace_file, 'check_interval': '0'})
+            self.assertFalse(message_log.enabled)
+
+            with open(trace_file, 'w', encoding='UTF-8') as file_object:
+                file_object.write('weather/loop\n')
+            message_log.check(time.time())
+            with mock.patch.object(logger, 'info') as mock_info:
+                message_log.published(1700000000, 7, 1, False, 'weather/loop/outTemp_F', '72.0')
+                message_log.published(1700000000, 8, 1, False, 'weather/archive', '{}')
+                message_log.acknowledged(7)
+
+            self.assertTrue(message_log.enabled)
+            traces = [json.loads(call.args[0]) for call in mock_info.call_args_list]
+            self.assertEqual([(trace['trace'], trace['mid']) for trace in traces], [('publish', 7), ('acknowledge', 7)])
+            self.assertEqual(traces[0]['topic'], 'weather/loop/outTemp_F')
+
+            os.remove(trace_file)
+            message_log.check(time.time())
+            self.assertFalse(message_log.enabled)
+
 if __name__ == '__main__':
     test_suite = unittest.TestSuite()                                                    # noqa: E265
     test_suite.addTest(TestDeprecatedOptions('test_PublishWeeWX_stanza_is_deprecated'))  # noqa: E265